@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/08/30 14:27:05
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import glob
+import hashlib
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+from responses import rescore_responses
+from columnar_events import load_events, EVENTS_SUFFIX
+
+opj = os.path.join
+
+GROUP_TABLE = 'group_analysis.tsv'
+RESCORE_SETTINGS = ['Response interval', 'Monitor refreshrate', 'Screentick conversion']
+# the columns of the events the analysis uses, only these are read from an events .npz
+EVENT_COLUMNS = ['trial_nr', 'onset', 'phase_length', 'block_type', 'block_ID', 'trial_type', 'response',
+                 'key_duration', 'response_button']
+
+
+def subject_dirs(output_root):
+    """ The output directories of all sessions in output_root (not in its subdirectories, e.g. dry runs). """
+    return sorted(directory for directory in glob.glob(opj(output_root, '*_Logs_rotating_sphere*'))
+                  if os.path.isdir(directory))
+
+
+def dir_signature(directory):
+    """ Hash of the names, sizes and modification times of the files in a directory, it changes with every new or changed file. """
+    signature = hashlib.sha1()
+    for name in sorted(os.listdir(directory)):
+        stat = os.stat(opj(directory, name))
+        signature.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return signature.hexdigest()
+
+
+def key_events(events, ignore_keys=()):
+    """ The button presses of a session (the rows with a key duration), without the keys in ignore_keys. """
+    if 'key_duration' not in events.columns:
+        return events.iloc[:0]
+    keys = events[events['key_duration'].notna() & ~events['response'].isin(ignore_keys)]
+    return keys
+
+
+def percept_durations(events, ignore_keys=()):
+    """
+    Percept durations in the ambiguous blocks. Presses are sorted by onset within every block,
+    a percept starts with every press of another button than the one before (repeated presses of
+    the same button don't count as a switch) and lasts until the next switch. The last percept
+    of a block has no end and is not included.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per complete percept: block_ID, response (button), onset and duration (in s)
+    """
+    keys = key_events(events, ignore_keys)
+    keys = keys[(keys['block_type'] == 'ambiguous') & (keys['trial_type'] == 'ambiguous')]
+    keys = keys.assign(onset=keys['onset'].astype(float)).sort_values(['block_ID', 'onset'], kind='mergesort')
+
+    block = keys['block_ID'].values
+    response = keys['response'].values
+    onset = keys['onset'].values
+    switch = np.ones(len(keys), dtype=bool)
+    switch[1:] = (block[1:] != block[:-1]) | (response[1:] != response[:-1])
+
+    block, response, onset = block[switch], response[switch], onset[switch]
+    # a percept ends with the next switch, if that is in the same block
+    complete = np.zeros(len(block), dtype=bool)
+    complete[:-1] = block[1:] == block[:-1]
+    duration = np.full(len(onset), np.nan)
+    duration[:-1] = np.diff(onset)
+    return pd.DataFrame({'block_ID': block[complete],
+                         'response': response[complete],
+                         'onset': onset[complete],
+                         'duration': duration[complete]})
+
+
+def response_validity(events, task_settings, ignore_keys=()):
+    """ The presses in the unambiguous trials, with reaction time and timing validity rescored (see responses.py). """
+    keys = key_events(events, ignore_keys)
+    if len(keys) == 0:
+        return keys
+    screenticks_per_frame = int(task_settings['Monitor refreshrate']/task_settings['Screentick conversion'])
+    if task_settings.get('Frame scheduling') == 'time':
+        screenticks_per_frame = task_settings['Monitor refreshrate']/task_settings['Screentick conversion']
+    rescored = rescore_responses(events, task_settings['Response interval'], screenticks_per_frame,
+                                 task_settings['Monitor refreshrate'])
+    return rescored[rescored['trial_type'].isin(['right', 'left']) & ~rescored['response'].isin(ignore_keys)]
+
+
+def read_events(directory):
+    """ The events of a session directory, from the events .npz if there is one (only EVENT_COLUMNS), else from the events.tsv. """
+    npz_files = glob.glob(opj(directory, '*'+EVENTS_SUFFIX))
+    if npz_files:
+        try:
+            return load_events(npz_files[0], EVENT_COLUMNS)
+        except KeyError as error:
+            # e.g. the npz files of older versions were saved without trial_nr
+            print(f"Reading the events.tsv instead, {error}")
+    events_files = glob.glob(opj(directory, '*_events.tsv'))
+    if not events_files:
+        return None
+    return pd.read_csv(events_files[0], sep='\t')
+
+
+def analyse_subject(directory):
+    """ Summary of one session directory, one row of the group table. """
+    name = os.path.basename(os.path.normpath(directory))
+    match = re.match(r'(sub-\d+)_(ses-[^_]+)', name)
+    subject, session = match.groups() if match else (name, '')
+    row = {'subject': subject, 'session': session, 'directory': name, 'signature': dir_signature(directory)}
+
+    events = read_events(directory)
+    if events is None:
+        return row
+
+    settings_files = glob.glob(opj(directory, '*_expsettings.yml'))
+    task_settings = None
+    ignore_keys = []
+    if settings_files:
+        with open(settings_files[0]) as f:
+            task_settings = yaml.safe_load(f)['Task settings']
+        ignore_keys = [*task_settings.get('Break buttons', []), task_settings.get('Exit key', 'q'), 's', 'p']
+
+    if 'response_button' in events.columns and events['response_button'].notna().any():
+        row['response_button'] = events['response_button'].dropna().iloc[0]
+
+    percepts = percept_durations(events, ignore_keys)
+    row['n_switches'] = len(percepts)
+    row['switch_times_mean'] = percepts['duration'].mean()
+    row['switch_times_std'] = percepts['duration'].std()
+    row['switch_times_median'] = percepts['duration'].median()
+
+    # sessions of older versions of the experiment don't have all the settings for rescoring
+    if task_settings is not None and all(key in task_settings for key in RESCORE_SETTINGS):
+        presses = response_validity(events, task_settings, ignore_keys)
+        in_time = presses['onset_delay_timing'] == 'in_time'
+        row['n_unambiguous_presses'] = len(presses)
+        row['in_time_ratio'] = in_time.mean() if len(presses) else np.nan
+        row['reaction_time_mean'] = presses.loc[in_time, 'reaction_time'].mean()
+    return row
+
+
+def analyse_group(output_root='./output_data', workers=None):
+    """
+    Analyses all session directories in output_root in a process pool and writes the group table
+    to <output_root>/group_analysis.tsv. Directories whose signature is the same as in the
+    existing table are not analysed again.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The group table, one row per session
+    """
+    table_path = opj(output_root, GROUP_TABLE)
+    previous = {}
+    if os.path.exists(table_path):
+        previous = {row['directory']: row for row in pd.read_csv(table_path, sep='\t').to_dict('records')}
+
+    rows = {}
+    changed = []
+    for directory in subject_dirs(output_root):
+        name = os.path.basename(directory)
+        if name in previous and previous[name]['signature'] == dir_signature(directory):
+            rows[name] = previous[name]
+        else:
+            changed.append(directory)
+
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for row in executor.map(analyse_subject, changed):
+                rows[row['directory']] = row
+    print(f"Analysed {len(changed)} new or changed sessions, {len(rows)-len(changed)} unchanged")
+
+    table = pd.DataFrame(list(rows.values()))
+    if len(table):
+        table = table.sort_values(['subject', 'session']).reset_index(drop=True)
+    table.to_csv(table_path, sep='\t', index=False)
+    return table
+
+
+def main():
+    """ python analysis.py [output_data] [number of processes] """
+    output_root = sys.argv[1] if len(sys.argv) > 1 else './output_data'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    table = analyse_group(output_root, workers)
+    print(table.drop(columns=['signature', 'directory'], errors='ignore').to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
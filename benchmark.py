@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/08/09 11:02:47
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import yaml
+from dry_run import DryRunSession, SyntheticKey
+from frame_player import FramePlayer
+from gaze_stream import GazeStream, ReplaySampleSource, synthetic_gaze
+
+opj = os.path.join
+
+# every startup parameter is varied on its own, the others keep their value from the settings file
+STARTUP_GRID = {('Stimulus settings', 'Stimulus resolution'): [100, 200, 400, 800],
+                ('Stimulus settings', 'Number frames'): [95, 190, 380],
+                ('Task settings', 'Blocks'): [2, 4, 8]}
+# the stimuli are rendered, so the benchmark doesn't need the bitmaps
+BASE_SETTINGS = {('Stimulus settings', 'Stimulus source'): 'generated',
+                 ('Stimulus settings', 'Stimulus resolution'): 200}
+DRAW_FLIPS = 2000
+LOG_SIZES = [0, 1000, 2500, 5000, 10000]
+GET_EVENTS_CALLS = 200
+# the gaze stream is fed at the sample rate of the EyeLink 1000, in chunks of one poll interval
+GAZE_SAMPLE_RATE = 1000
+GAZE_POLL_INTERVALS = [0.002, 0.0167]
+GAZE_UPDATES = 2000
+# a run is flagged if a timing got slower than this fraction compared to the previous run
+REGRESSION_THRESHOLD = 0.2
+
+
+class FrameCopyPlayer(FramePlayer):
+    """
+    Headless frame player. Instead of drawing the texture it copies the frame into a buffer,
+    so the frame lookup and the memory access of the frames are part of the measured draw.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.nr_of_frames = frames.shape[0]
+        self.buffer = np.empty(frames.shape[1:], dtype=frames.dtype)
+
+    def draw(self, i, direction=1):
+        np.copyto(self.buffer, self.frames[self.frame_index(i, direction)])
+
+
+class BenchmarkSession(DryRunSession):
+    """ Dry run session that measures its setup steps and the saving of the output. """
+
+    def __init__(self, *args, **kwargs):
+        self.measurements = {}
+        super().__init__(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """ Stores the duration (and the peak memory, if tracemalloc is running) of the block under name. """
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.measurements[name+'_s'] = time.perf_counter() - start
+        if tracemalloc.is_tracing():
+            self.measurements[name+'_peak_mb'] = (tracemalloc.get_traced_memory()[1] - start_memory)/2**20
+
+    def create_trials(self):
+        with self.measure('create_trials'):
+            super().create_trials()
+
+    def create_stimuli(self):
+        with self.measure('create_stimuli'):
+            super().create_stimuli()
+            self.ambiguous_player = FrameCopyPlayer(self.load_display_frames('ambiguous'))
+            self.unambiguous_player = FrameCopyPlayer(self.load_display_frames('unambiguous'))
+
+    def save_output(self):
+        self.measurements['log_rows'] = self.global_log.shape[0] + len(self.event_buffer)
+        with self.measure('save_output'):
+            super().save_output()
+
+
+def write_settings(settings_file, overrides, directory):
+    """ Writes a copy of the settings with the overrides ({(section, key): value}) and returns its path. """
+    with open(settings_file) as f:
+        settings = yaml.safe_load(f)
+    for (section, key), value in {**BASE_SETTINGS, **overrides}.items():
+        settings[section][key] = value
+    settings['Stimulus settings']['Bundle path'] = opj(directory, 'bundles')
+    path = opj(directory, 'settings.yml')
+    with open(path, 'w') as f:
+        yaml.dump(settings, f)
+    return path
+
+
+def build_session(settings_file, directory, trace=False):
+    """ Creates a BenchmarkSession, optionally while tracemalloc is running. """
+    if trace:
+        tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            session = BenchmarkSession('sub-001_ses-1', opj(directory, 'output'), settings_file, 1)
+    finally:
+        if trace:
+            tracemalloc.stop()
+    if session.journal is not None:
+        session.journal.close()
+        session.journal = None
+    return session
+
+
+def timing_statistics(durations_ns):
+    durations = np.asarray(durations_ns)/1000
+    return {'n': len(durations),
+            'mean_us': durations.mean(),
+            'median_us': np.median(durations),
+            'p99_us': np.percentile(durations, 99),
+            'max_us': durations.max()}
+
+
+def benchmark_startup(settings_file):
+    """
+    Session setup for every value of the startup grid. The first setup renders the spheres into
+    an empty cache (cold), the second loads them from the cache (warm), the third one measures
+    the peak memory of create_trials and create_stimuli.
+    """
+    results = []
+    for (section, key), values in STARTUP_GRID.items():
+        for value in values:
+            with tempfile.TemporaryDirectory() as directory:
+                path = write_settings(settings_file, {(section, key): value}, directory)
+                cold = build_session(path, directory).measurements
+                warm = build_session(path, directory).measurements
+                traced = build_session(path, directory, trace=True).measurements
+            results.append({'parameter': key, 'value': value,
+                            'create_trials_s': warm['create_trials_s'],
+                            'create_stimuli_s': warm['create_stimuli_s'],
+                            'create_stimuli_cold_s': cold['create_stimuli_s'],
+                            'create_trials_peak_mb': traced['create_trials_peak_mb'],
+                            'create_stimuli_peak_mb': traced['create_stimuli_peak_mb']})
+            print(f"startup {key}={value}: trials {warm['create_trials_s']:.3f}s, stimuli {warm['create_stimuli_s']:.3f}s "
+                  f"({cold['create_stimuli_s']:.3f}s cold), peak {traced['create_stimuli_peak_mb']:.1f}MB")
+    return results
+
+
+def block_label(trial):
+    return 'break' if trial.trial_type == 'break' else trial.block_type
+
+
+def benchmark_draw(session, n_flips=DRAW_FLIPS):
+    """ Cost of one draw_stimulus call, for the first trial of every block type. """
+    trials = {}
+    for trial in [*[trial for block in session.practice_blocks for trial in block], *session.trial_list]:
+        trials.setdefault(block_label(trial), trial)
+
+    results = {}
+    for label, trial in trials.items():
+        session.current_trial = trial
+        # the frame schedule has one entry per sphere frame, also for continuous trials
+        n_phases = len(trial.phase_durations) if trial.player is None else len(trial.frame_schedule)
+        durations = np.empty(n_flips, dtype=np.int64)
+        for flip in range(n_flips):
+            start = time.perf_counter_ns()
+            session.draw_stimulus(flip % n_phases)
+            durations[flip] = time.perf_counter_ns() - start
+        results[label] = timing_statistics(durations)
+        print(f"draw_stimulus {label}: {results[label]['median_us']:.1f}us median")
+    return results
+
+
+def benchmark_get_events(session, log_sizes=LOG_SIZES, n_calls=GET_EVENTS_CALLS):
+    """
+    Cost of RSTrial.get_events in an unambiguous trial while the global log has a given number
+    of rows, without key presses and with one press per call. The cost of logging a new phase
+    (log_phase_info) is measured as well, since it also writes into the growing log.
+    """
+    trial = next(trial for trial in session.trial_list if trial.block_type == 'unambiguous' and trial.trial_type != 'break')
+    session.current_trial = trial
+    session.current_trial_start_time = session.kb.clock.getTime()
+    # the phases are written into the global log like in a real session, not buffered like in the dry run
+    session.add_phase_rows()
+    session.buffer_phases = False
+    trial.log_phase_info(phase=0)
+    # the presses are released 0.7s after the trial onset, with a valid reaction time
+    session.time.advance(1.0)
+    template = session.global_log.copy()
+
+    results = []
+    for n_rows in log_sizes:
+        rows = np.arange(max(n_rows, 1)) % len(template)
+        session.global_log = template.iloc[rows].reset_index(drop=True)
+        session.event_buffer.clear()
+
+        idle = np.empty(n_calls, dtype=np.int64)
+        for call in range(n_calls):
+            start = time.perf_counter_ns()
+            trial.get_events()
+            idle[call] = time.perf_counter_ns() - start
+
+        pressed = np.empty(n_calls, dtype=np.int64)
+        for call in range(n_calls):
+            session.kb.queue([SyntheticKey('j', session.trial_onsets[trial.trial_nr][0] + 0.5, 0.2)])
+            start = time.perf_counter_ns()
+            trial.get_events()
+            pressed[call] = time.perf_counter_ns() - start
+
+        logged = np.empty(n_calls//4, dtype=np.int64)
+        for call in range(len(logged)):
+            start = time.perf_counter_ns()
+            trial.log_phase_info(phase=1)
+            logged[call] = time.perf_counter_ns() - start
+
+        results.append({'log_rows': n_rows,
+                        'get_events': timing_statistics(idle),
+                        'get_events_with_press': timing_statistics(pressed),
+                        'log_phase_info': timing_statistics(logged)})
+        print(f"get_events at {n_rows} rows: {results[-1]['get_events']['median_us']:.1f}us, "
+              f"with press {results[-1]['get_events_with_press']['median_us']:.1f}us, "
+              f"log_phase_info {results[-1]['log_phase_info']['median_us']:.1f}us")
+    session.event_buffer.clear()
+    return results
+
+
+def benchmark_gaze(poll_intervals=GAZE_POLL_INTERVALS, n_updates=GAZE_UPDATES):
+    """
+    Cost of one update of the gaze stream (reading the new samples and checking the fixation),
+    which the background thread does every poll interval, and of reading the fixation_lost
+    flag, which the trials do every flip. The samples are replayed on a virtual clock.
+    """
+    samples = synthetic_gaze(np.random.default_rng(0), 60, GAZE_SAMPLE_RATE)
+    results = {}
+    for poll_interval in poll_intervals:
+        now = [0.0]
+        stream = GazeStream(ReplaySampleSource(samples, lambda: now[0]), fixation_radius=60)
+        updates = np.empty(n_updates, dtype=np.int64)
+        reads = np.empty(n_updates, dtype=np.int64)
+        for update in range(n_updates):
+            now[0] += poll_interval
+            start = time.perf_counter_ns()
+            stream.update()
+            updates[update] = time.perf_counter_ns() - start
+            start = time.perf_counter_ns()
+            stream.fixation_lost
+            reads[update] = time.perf_counter_ns() - start
+        results[f'poll_{poll_interval*1000:g}ms'] = {'update': timing_statistics(updates),
+                                                      'fixation_lost': timing_statistics(reads)}
+        print(f"gaze stream every {poll_interval*1000:g}ms: update {results[f'poll_{poll_interval*1000:g}ms']['update']['median_us']:.1f}us median")
+    return results
+
+
+def benchmark_save(settings_file, directory):
+    """ Runs a whole dry run session and measures how long saving its output takes. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        session = BenchmarkSession('sub-001_ses-1', opj(directory, 'save'), settings_file, 1)
+        session.run()
+    output_size = sum(os.path.getsize(opj(session.output_dir, name)) for name in os.listdir(session.output_dir))
+    result = {'log_rows': session.measurements['log_rows'],
+              'save_output_s': session.measurements['save_output_s'],
+              'output_mb': output_size/2**20}
+    print(f"save_output: {result['save_output_s']:.3f}s for {result['log_rows']} rows")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def flatten(results, prefix=''):
+    """ All timings of a result dict as {'section/.../name': value}, list entries are keyed by their parameters. """
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}/{key}"))
+    elif isinstance(results, list):
+        for entry in results:
+            if 'parameter' in entry:
+                name = f"{entry['parameter']}={entry['value']}"
+            else:
+                name = f"log_rows={entry['log_rows']}"
+            flat.update(flatten(entry, f"{prefix}/{name}"))
+    elif prefix.endswith(('_s', 'median_us')):
+        flat[prefix] = results
+    return flat
+
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    """ Returns the timings that got more than threshold slower than in the previous run. """
+    previous_timings = flatten({key: previous[key] for key in previous if key != 'meta'})
+    current_timings = flatten({key: current[key] for key in current if key != 'meta'})
+    regressions = {}
+    for name, value in current_timings.items():
+        old = previous_timings.get(name)
+        if old and value > old*(1+threshold):
+            regressions[name] = {'previous': old, 'current': value, 'ratio': value/old}
+    return regressions
+
+
+def run_benchmarks(settings_file='./settings.yml', output_dir='./output_data/benchmarks/'):
+    """ Runs all benchmarks and writes them to <output_dir>/benchmark_<date>.json, returns the results. """
+    results = {'meta': {'date': datetime.now().isoformat(timespec='seconds'),
+                        'commit': git_commit(),
+                        'settings_file': settings_file,
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'pandas': pd.__version__,
+                        'machine': platform.platform(),
+                        'processor': platform.processor()}}
+
+    results['startup'] = benchmark_startup(settings_file)
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_settings(settings_file, {('Task settings', 'Test eyetracker'): True}, directory)
+        session = build_session(path, directory)
+        results['draw_stimulus'] = benchmark_draw(session)
+        results['get_events'] = benchmark_get_events(session)
+        results['gaze_stream'] = benchmark_gaze()
+        results['save_output'] = benchmark_save(write_settings(settings_file, {}, directory), directory)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output_file = opj(output_dir, 'benchmark_'+datetime.now().strftime('%Y%m%d%H%M%S')+'.json')
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2, default=float)
+    print(f"Results written to {output_file}")
+    return results
+
+
+def main():
+    """
+    python benchmark.py [settings.yml] [previous benchmark.json]
+    With a previous result file, the timings that got slower are listed and the exit code is 1.
+    """
+    settings_file = sys.argv[1] if len(sys.argv) > 1 else './settings.yml'
+    results = run_benchmarks(settings_file)
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            previous = json.load(f)
+        regressions = compare(previous, json.loads(json.dumps(results, default=float)))
+        for name, regression in regressions.items():
+            print(f"SLOWER {name}: {regression['previous']:.6g} -> {regression['current']:.6g} ({regression['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No timing got more than {REGRESSION_THRESHOLD:.0%} slower")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/10/11 09:52:16
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+import yaml
+
+opj = os.path.join
+
+EVENTS_SUFFIX = '_events.npz'
+# columns with few distinct strings, stored as integer codes and the list of their values
+CATEGORICAL_COLUMNS = ['block_type', 'trial_type', 'event_type', 'response']
+# entries of the file that are not columns
+COLUMNS_KEY = '__columns__'
+SETTINGS_KEY = '__settings__'
+
+
+def events_path(output_dir, output_str):
+    return opj(output_dir, output_str+EVENTS_SUFFIX)
+
+
+def save_events(events, path, settings=None):
+    """
+    Saves the events of a session as a compressed .npz with one array per column, next to the
+    events.tsv. Numeric columns keep their dtype, the categorical columns (and other columns with
+    strings) are stored as codes (-1 for empty cells) and categories. The settings of the session
+    are stored as yaml, so the file can be analysed without the expsettings.yml. A named index is
+    saved as a column (exptools' save_output moves trial_nr into the index of the global log).
+    """
+    if events.index.name is not None:
+        events = events.reset_index()
+    arrays = {}
+    for column in events.columns:
+        values = events[column]
+        if column not in CATEGORICAL_COLUMNS and values.dtype == object:
+            # object columns that only hold numbers and nan (e.g. after merging the button presses) are numeric
+            try:
+                values = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                pass
+        if column in CATEGORICAL_COLUMNS or values.dtype == object:
+            codes, categories = pd.factorize(values)
+            arrays[column+'.codes'] = codes.astype(np.int8 if len(categories) < 128 else np.int32)
+            arrays[column+'.categories'] = np.asarray(categories.astype(str), dtype=str)
+        else:
+            arrays[column] = values.to_numpy()
+    arrays[COLUMNS_KEY] = np.array(events.columns, dtype=str)
+    arrays[SETTINGS_KEY] = np.array(yaml.safe_dump(settings) if settings is not None else '')
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # np.savez adds .npz to names without it, so the temporary file keeps the extension
+    tmp_path = path[:-len('.npz')]+'.tmp.npz'
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_events(path, columns=None):
+    """
+    Loads the events saved with save_events. The columns of an .npz are compressed separately and
+    only the selected ones are read and decompressed. Categorical columns are returned as pandas
+    categoricals.
+
+    Parameters
+    ----------
+    path : str
+        Path of the <output>_events.npz
+    columns : list
+        Columns to load in this order, all by default
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    with np.load(path, allow_pickle=False) as arrays:
+        available = list(arrays[COLUMNS_KEY])
+        if columns is None:
+            columns = available
+        missing = [column for column in columns if column not in available]
+        if missing:
+            raise KeyError(f"{path} has no columns {missing}, it has {available}")
+        data = {}
+        for column in columns:
+            if column+'.codes' in arrays.files:
+                data[column] = pd.Categorical.from_codes(arrays[column+'.codes'], arrays[column+'.categories'])
+            else:
+                data[column] = arrays[column]
+    return pd.DataFrame(data, columns=columns)
+
+
+def load_settings(path):
+    """ The settings of the session stored in an events .npz, or None. """
+    with np.load(path, allow_pickle=False) as arrays:
+        settings = str(arrays[SETTINGS_KEY])
+    return yaml.safe_load(settings) if settings else None
+
+
+def load_sessions(paths, columns=None):
+    """
+    Loads the selected columns of many sessions into one DataFrame, with the output name of each
+    session (e.g. sub-001_ses-1) in the column 'session'. Directories are searched for their
+    events .npz. Categorical columns stay categorical over all sessions.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(opj(path, '*'+EVENTS_SUFFIX))) if os.path.isdir(path) else [path])
+
+    sessions = []
+    for path in files:
+        events = load_events(path, columns)
+        events.insert(0, 'session', os.path.basename(path)[:-len(EVENTS_SUFFIX)])
+        sessions.append(events)
+    if not sessions:
+        return pd.DataFrame(columns=['session', *(columns or [])])
+    events = pd.concat(sessions, ignore_index=True)
+    # categories that differ between the sessions fall back to object in concat
+    for column in ['session', *CATEGORICAL_COLUMNS]:
+        if column in events.columns:
+            events[column] = events[column].astype('category')
+    return events
+
+
+def main():
+    """ Converts the events.tsv of finished sessions: python columnar_events.py <output_dir> [<output_dir> ...] """
+    for directory in sys.argv[1:]:
+        for tsv in sorted(glob.glob(opj(directory, '*_events.tsv'))):
+            output_str = os.path.basename(tsv)[:-len('_events.tsv')]
+            settings = None
+            settings_file = opj(directory, output_str+'_expsettings.yml')
+            if os.path.exists(settings_file):
+                with open(settings_file) as f:
+                    settings = yaml.safe_load(f)
+            save_events(pd.read_csv(tsv, sep='\t'), events_path(directory, output_str), settings)
+            print(f"{tsv} -> {events_path(directory, output_str)}")
+
+
+if __name__ == '__main__':
+    main()
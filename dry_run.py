@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/08/02 13:18:25
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import os
+import re
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import yaml
+from session import RotatingSphereSession
+from frame_player import FramePlayer
+from tracker_messages import DummyTracker, TrackerMessageQueue
+from gaze_stream import GazeStream, ReplaySampleSource, synthetic_gaze
+
+opj = os.path.join
+
+
+class VirtualTime(object):
+    """ The time of a dry run, it only moves forward when the window flips. """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, dt):
+        self.now += dt
+
+
+class VirtualClock(object):
+    """ Stand-in for psychopy.core.Clock that runs on the virtual time. """
+
+    def __init__(self, time):
+        self.time = time
+        self.start = time.now
+
+    def getTime(self):
+        return self.time.now - self.start
+
+    def reset(self, newT=0.0):
+        self.start = self.time.now - newT
+
+    def add(self, t):
+        self.start += t
+
+
+class NullWindow(object):
+    """
+    Stand-in for the psychopy window. A flip doesn't draw anything, it only moves the virtual
+    time forward by one refresh and calls the functions registered with callOnFlip, and
+    after_flip (if given) after every flip.
+    """
+
+    def __init__(self, time, monitor_refreshrate, after_flip=None):
+        self.time = time
+        self.after_flip = after_flip
+        self.frame_period = 1/monitor_refreshrate
+        self.lastFrameT = time.now
+        self.frameIntervals = []
+        self.recordFrameIntervals = False
+        self.on_flip = []
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self.on_flip.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        self.time.advance(self.frame_period)
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(self.time.now - self.lastFrameT)
+        self.lastFrameT = self.time.now
+        on_flip, self.on_flip = self.on_flip, []
+        for function, args, kwargs in on_flip:
+            function(*args, **kwargs)
+        if self.after_flip is not None:
+            self.after_flip()
+        return self.lastFrameT
+
+    def getMovieFrame(self, *args, **kwargs):
+        pass
+
+    def saveMovieFrames(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullStim(object):
+    """ Stand-in for the psychopy stimuli, drawing does nothing. """
+
+    def draw(self):
+        pass
+
+
+class NullFramePlayer(FramePlayer):
+    """ Frame player without textures, it only counts how often every frame was drawn. """
+
+    def __init__(self, nr_of_frames):
+        self.nr_of_frames = nr_of_frames
+        self.draw_counts = np.zeros(nr_of_frames, dtype=int)
+
+    def draw(self, i, direction=1):
+        self.draw_counts[self.frame_index(i, direction)] += 1
+
+
+class SyntheticKey(object):
+    """ Button press with the attributes of psychopy's KeyPress that the trials use. """
+
+    def __init__(self, name, rt, duration):
+        self.name = name
+        self.rt = rt
+        self.tDown = rt
+        self.duration = duration
+
+    def __eq__(self, other):
+        # like psychopy's KeyPress, a key can be compared to its name
+        if isinstance(other, str):
+            return self.name == other
+        return self is other
+
+    def __hash__(self):
+        return id(self)
+
+
+class SyntheticKeyboard(object):
+    """
+    Stand-in for psychopy's Keyboard. The responder queues presses in advance, and getKeys
+    returns them once they were released (or pressed, with waitRelease=False) on the virtual clock.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queued = []
+
+    def queue(self, keys):
+        self.queued.extend(keys)
+        self.queued.sort(key=lambda key: key.rt + key.duration)
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        now = self.clock.getTime()
+        done = [key for key in self.queued
+                if (key.rt + key.duration if waitRelease else key.rt) <= now
+                and (keyList is None or key.name in keyList)]
+        if clear and done:
+            self.queued = [key for key in self.queued if key not in done]
+        return done
+
+    def clearEvents(self):
+        self.queued = []
+
+
+class SyntheticResponder(object):
+    """
+    Model of a participant that produces the button presses of a trial when it starts:
+    - unambiguous trials: one press of the button of the rotation direction, after a reaction time
+    - ambiguous trials: presses that alternate between the buttons, with gamma distributed percept durations
+    - breaks: the break button, after the participant rested for a while
+    All times are drawn from a random generator seeded with the subject ID.
+    """
+
+    def __init__(self, responder_settings, subject_ID):
+        self.buttons = {'right': responder_settings['Right button'],
+                        'left': responder_settings['Left button']}
+        self.reaction_time = responder_settings['Reaction time']
+        self.key_duration = responder_settings['Key duration']
+        self.percept_duration = responder_settings['Percept duration']
+        self.break_wait = responder_settings['Break wait']
+        self.rng = np.random.default_rng(subject_ID)
+
+    def draw_duration(self, mean_std):
+        return max(self.rng.normal(*mean_std), 0.01)
+
+    def responses(self, trial, start_time, session):
+        """ Returns the presses (SyntheticKey) of a trial that starts at start_time (keyboard clock). """
+        if trial.trial_type == 'break':
+            # only the first phase of a break waits for a button, and it must not end up in the next trial
+            if self.break_wait < trial.phase_durations[0]/session.monitor_refreshrate:
+                return [SyntheticKey(session.break_buttons[0], start_time + self.break_wait, self.draw_duration(self.key_duration))]
+            return []
+
+        if trial.player is None:
+            return []
+
+        if trial.block_type.startswith('unambiguous'):
+            direction = 'left' if trial.direction == -1 else 'right'
+            return [SyntheticKey(self.buttons[direction], start_time + self.draw_duration(self.reaction_time),
+                                 self.draw_duration(self.key_duration))]
+
+        keys = []
+        t = start_time + self.draw_duration(self.reaction_time)
+        percept = self.rng.choice(['right', 'left'])
+        while t < start_time + trial.duration:
+            keys.append(SyntheticKey(self.buttons[percept], t, self.draw_duration(self.key_duration)))
+            t += self.rng.gamma(*self.percept_duration)
+            percept = 'left' if percept == 'right' else 'right'
+        return keys
+
+
+class DryRunSession(RotatingSphereSession):
+    """
+    Runs the real trial list of a session without window, keyboard or eyetracker (or with a
+    DummyTracker, see 'Eyetracker' in the 'Dry run' settings). The trials run their normal phase
+    and draw logic, but the window only moves a virtual clock forward at every flip, and the
+    button presses come from a SyntheticResponder. A session therefore runs as fast as the CPU
+    allows, and writes the same output files as a real session.
+
+    The exptools session is not initialized (it would open a window), the attributes of it that
+    the trials and the output rely on are set up here instead.
+    """
+
+    # the phase rows are added to the global log once per trial (see log_phase)
+    buffer_phases = True
+
+    def __init__(self, output_str, output_dir, settings_file, subject_ID, practice=False):
+        """
+        Parameters
+        ----------
+        output_str : str
+            Basename for all output-files (like logs)
+        output_dir : str
+            Path to the output-directory
+        settings_file : str
+            Path to yaml-file with settings
+        subject_ID : int
+            ID of the simulated participant, also the seed of the responder
+        practice : bool
+            If the practice blocks are run as well
+        """
+        with open(settings_file) as f:
+            self.settings = yaml.safe_load(f)
+        self.settings_file = settings_file
+        self.output_str = output_str
+        self.output_dir = output_dir
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        with open(opj(output_dir, output_str+'_expsettings.yml'), 'w') as f:
+            yaml.dump(self.settings, f)
+
+        self.time = VirtualTime()
+        self.clock = VirtualClock(self.time)
+        self.timer = VirtualClock(self.time)
+        monitor_refreshrate = self.settings['Task settings']['Monitor refreshrate']
+        self.win = NullWindow(self.time, monitor_refreshrate, self.send_tracker_messages)
+        self.actual_framerate = monitor_refreshrate
+        self.global_log = pd.DataFrame(columns=['trial_nr', 'onset', 'event_type', 'phase', 'response', 'nr_frames'])
+        # rows of the phases that are not in the global log yet (see log_phase)
+        self.phase_rows = []
+        self.nr_frames = 0
+        self.first_trial = True
+        self.exp_start = None
+        self.exp_stop = None
+        # the eyetracker messages can go to a DummyTracker, to run them through the message queue
+        self.eyetracker_on = self.settings['Dry run']['Eyetracker']
+        self.tracker = None
+        if self.eyetracker_on:
+            # the latency of the link is counted on the virtual clock
+            self.tracker = DummyTracker(self.settings['Dry run']['Tracker latency'], self.tracker_clock, sleep=None)
+        self.tracker_messages = None
+        self.mri_simulator = None
+        self.closed = False
+
+        self.practice = practice
+        self.responder = SyntheticResponder(self.settings['Dry run'], subject_ID)
+        # the schedule is created in a temporary directory (with the same result), the dry run often uses other
+        # settings than the stored schedules of the real sessions were made with
+        self.schedule_dir = tempfile.TemporaryDirectory(prefix='dry_run_schedules_')
+        self.settings['Task settings']['Schedule path'] = self.schedule_dir.name
+        self.setup_task(subject_ID)
+
+    def create_keyboard(self):
+        return SyntheticKeyboard(VirtualClock(self.time))
+
+    def create_input_thread(self):
+        # the presses are read in the frame loop, a thread in real time would make the dry run depend on the CPU
+        return None
+
+    def tracker_clock(self):
+        return self.time.now
+
+    def create_tracker_messages(self):
+        # the messages are sent after every flip instead of by a thread in real time, like the keyboard is read
+        return TrackerMessageQueue(self.tracker, self.tracker_clock, self.settings['Task settings']['Tracker backlog'],
+                                   threaded=False)
+
+    def send_tracker_messages(self):
+        if self.tracker_messages is not None:
+            self.tracker_messages.send_pending()
+
+    def log_phase(self, trial, phase=None):
+        # the same row as exptools' Trial.log_phase_info, but it is only added to the global log at the end of the
+        # trial: adding it one cell at a time took most of the time of a dry run with one phase per sphere frame
+        if not self.buffer_phases:
+            return super().log_phase(trial, phase)
+        onset = self.clock.getTime()
+        if phase is None:
+            phase = trial.phase
+        self.phase_rows.append({'trial_nr': trial.trial_nr, 'onset': onset, 'event_type': 'stim', 'phase': phase,
+                                'nr_frames': self.nr_frames, **trial.parameters})
+        if trial.eyetracker_on:
+            self.tracker.sendMessage(f'start_type-stim_trial-{trial.trial_nr}_phase-{phase}')
+        self.nr_frames = 0
+        return onset
+
+    def log_length(self):
+        return self.global_log.shape[0] + len(self.phase_rows)
+
+    def add_phase_rows(self):
+        """ Adds the rows of the phases that were logged since the last call to the global log. """
+        if self.phase_rows:
+            self.global_log = pd.concat([self.global_log, pd.DataFrame(self.phase_rows)], ignore_index=True)
+            self.phase_rows = []
+
+    def journal_trial(self):
+        self.add_phase_rows()
+        super().journal_trial()
+
+    def save_output(self):
+        self.add_phase_rows()
+        super().save_output()
+
+    def create_gaze_stream(self):
+        # a minute of synthetic samples played in a loop on the virtual clock
+        if not (self.eyetracker_on and self.settings['Task settings']['Gaze stream']):
+            return None
+        dry_run_settings = self.settings['Dry run']
+        samples = synthetic_gaze(np.random.default_rng(self.subject_ID), 60, dry_run_settings['Gaze sample rate'],
+                                 dry_run_settings['Gaze noise'], dry_run_settings['Gaze lapse rate'])
+        return GazeStream(ReplaySampleSource(samples, self.tracker_clock), self.fixation_radius_pix,
+                          self.settings['Task settings']['Gaze window'])
+
+    def fixation_lost(self):
+        # the samples are read in the frame loop instead of a thread, like the keyboard
+        if self.gaze_stream is None:
+            return False
+        self.gaze_stream.update()
+        return self.gaze_stream.fixation_lost
+
+    def calibrate_eyetracker(self):
+        pass
+
+    def start_recording_eyetracker(self):
+        pass
+
+    def create_stimuli(self):
+        self.fixation_dot = NullStim()
+        self.eye_tracking_test = [NullStim() for _ in range(4)]
+        self.break_stim = NullStim()
+        self.ambiguous_player = NullFramePlayer(self.nr_of_frames)
+        self.unambiguous_player = NullFramePlayer(self.nr_of_frames)
+
+    def run_trial(self, trial):
+        start_time = self.kb.clock.getTime()
+        self.kb.queue(self.responder.responses(trial, start_time, self))
+        super().run_trial(trial)
+
+    def display_text(self, text, keys=None, **kwargs):
+        pass
+
+    def wait_for_yesno(self, text):
+        # do the practice blocks once if asked for, then go on with the experiment
+        return self.practice
+
+    def start_experiment(self, *args, **kwargs):
+        self.exp_start = self.clock.getTime()
+        self.clock.reset()
+        self.timer.reset()
+        self.win.recordFrameIntervals = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.exp_stop = self.clock.getTime()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        self.close_tracker_messages()
+        self.ambiguous_player.close()
+        self.unambiguous_player.close()
+        self.save_output()
+        self.structured_log.close()
+        self.schedule_dir.cleanup()
+        self.closed = True
+
+    def quit(self):
+        raise SystemExit
+
+
+def dry_run(subject, sess, settings_file='./settings.yml', output_root='./output_data/dry_run', practice=False):
+    """ Runs the dry run of one participant (e.g. 'sub-001', 'ses-1') and returns the session. """
+    subject_ID = int(re.findall(r'(?<=-)\d+', subject)[0])
+    output_str = subject + '_' + sess
+    output_dir = opj(output_root, output_str+'_Logs_rotating_sphere')
+    session = DryRunSession(output_str, output_dir, settings_file, subject_ID, practice=practice)
+    session.run()
+    return session
+
+
+def main():
+    """
+    Dry run for a range of participants: python dry_run.py <first ID>-<last ID> [settings.yml]
+    e.g. python dry_run.py 1-40
+    """
+    first, last = (int(i) for i in sys.argv[1].split('-'))
+    settings_file = sys.argv[2] if len(sys.argv) > 2 else './settings.yml'
+    for subject_ID in range(first, last+1):
+        session = dry_run(f'sub-{subject_ID:03d}', 'ses-1', settings_file)
+        print(f"sub-{subject_ID:03d}: {len(session.trial_list)} trials, {session.exp_stop:.1f}s virtual time, "
+              f"start condition {session.start_condition}, response button {session.response_button}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/07/05 09:47:18
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import numpy as np
+import pandas as pd
+
+
+class EventBuffer(object):
+    """
+    Append-only columnar store for events that happen during the frame loop (button presses).
+    Every column is a preallocated typed array that doubles its size when it is full, so
+    recording an event costs the same no matter how long the session already is. The events
+    only become a DataFrame when they are merged into the global log for saving.
+    """
+
+    def __init__(self, columns, capacity=256):
+        """
+        Parameters
+        ----------
+        columns : dict
+            Column names and their dtypes (float, int or object), in the order in which they
+            should appear in the output
+        capacity : int
+            Number of events that fit in before the arrays have to grow
+        """
+        self.columns = dict(columns)
+        self.capacity = capacity
+        self.data = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+        # row of the global log every event would have had if it was written there directly
+        self.positions = np.empty(capacity, dtype=int)
+        self.n_events = 0
+
+    def __len__(self):
+        return self.n_events
+
+    def grow(self):
+        self.capacity *= 2
+        for name, values in self.data.items():
+            grown = np.empty(self.capacity, dtype=values.dtype)
+            grown[:self.n_events] = values[:self.n_events]
+            self.data[name] = grown
+        positions = np.empty(self.capacity, dtype=int)
+        positions[:self.n_events] = self.positions[:self.n_events]
+        self.positions = positions
+
+    def append(self, position, values):
+        """
+        Records one event. Columns that are missing in values are left empty (NaN).
+
+        Parameters
+        ----------
+        position : int
+            Row of the global log this event belongs to
+        values : dict
+            Column name -> value
+        """
+        if self.n_events == self.capacity:
+            self.grow()
+        for name, column in self.data.items():
+            column[self.n_events] = values.get(name, np.nan)
+        self.positions[self.n_events] = position
+        self.n_events += 1
+
+    def snapshot(self, start=0):
+        """ Copies of the recorded values (from event number start on) and their positions, to hand them to another thread. """
+        return ({name: values[start:self.n_events].copy() for name, values in self.data.items()},
+                self.positions[start:self.n_events].copy())
+
+    def to_dataframe(self, start=0):
+        """ The recorded events (from event number start on) as a DataFrame, indexed by their position in the global log. """
+        return pd.DataFrame({name: values[start:self.n_events] for name, values in self.data.items()},
+                            index=self.positions[start:self.n_events])
+
+    def merge_into(self, global_log, log_start=0, event_start=0):
+        """
+        Returns the global log with the recorded events inserted at the rows they would have
+        had if they had been written into it directly, so the saved events file looks the
+        same as before. With log_start and event_start only the part of the log that was
+        added after that many log rows and events is returned.
+        """
+        return merge_events(global_log.iloc[log_start:], self.to_dataframe(event_start), log_start + event_start)
+
+    def clear(self):
+        self.n_events = 0
+
+
+def merge_events(log_rows, events, start=0):
+    """
+    Inserts events (a DataFrame indexed by their position, see EventBuffer.to_dataframe) into
+    rows of the global log. start is the position of the first of the rows, counting the rows
+    and the events before them.
+    """
+    if len(events) == 0:
+        return log_rows.copy()
+    is_event = np.zeros(len(log_rows) + len(events), dtype=bool)
+    is_event[events.index.to_numpy() - start] = True
+    log_rows = log_rows.copy()
+    log_rows.index = start + np.flatnonzero(~is_event)
+
+    merged = pd.concat([log_rows, events]).sort_index()
+    return merged.reset_index(drop=True)
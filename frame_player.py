@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/06/28 11:05:52
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from psychopy import visual
+
+
+def frame_schedule(n_phases, last_frame_previous, nr_of_frames):
+    """
+    Frame index of every phase of a trial: the rotation continues after the frame
+    the previous trial of the same direction ended with (see create_unambiguous_block).
+    """
+    return (np.arange(n_phases) + last_frame_previous + 1) % nr_of_frames
+
+
+def frame_image(frame):
+    """
+    Image of a frame for an ImageStim. The frames are stored as grey values, but psychopy turns
+    a grey ('L') image into a float texture with three channels (12 bytes per pixel), an RGB
+    image becomes an 8 bit RGBA texture (4 bytes per pixel), like the bitmaps of the stimuli.
+    """
+    return Image.fromarray(np.asarray(frame)).convert('RGB')
+
+
+class FramePlayer(object):
+    """
+    Plays one sphere sequence. The frames are kept as one stacked array
+    (frames x height x width) and every frame is turned into a texture only once.
+    The left rotation is the right rotation played backwards, so both directions
+    share the same frames and textures.
+
+    The frames are separate ImageStims and not one atlas texture: an ImageStim always
+    shows its whole texture, and an atlas would hold the same pixels.
+    """
+
+    def __init__(self, win, frames, units='deg', size=None, autoLog=True):
+        """
+        Parameters
+        ----------
+        win : psychopy.visual.Window
+            Window the sphere is drawn in
+        frames : numpy.ndarray
+            Stacked frames of one full right rotation (frames x height x width), e.g. a
+            memory-mapped stimulus bundle
+        units : str
+            Units of the stimulus size
+        size : float
+            Size of the stimulus
+        autoLog : bool
+            If the textures log their creation to psychopy's log, one long entry per frame
+        """
+        self.frames = frames
+        self.nr_of_frames = len(frames)
+        self.stims = [visual.ImageStim(win, image=frame_image(frame), units=units, size=size, autoLog=autoLog)
+                      for frame in frames]
+
+    def frame_index(self, i, direction=1):
+        """
+        Index into the stored (right rotation) frames of frame i when playing in the given
+        direction (1 for right, -1 for left).
+        """
+        i = i % self.nr_of_frames
+        return i if direction == 1 else self.nr_of_frames - 1 - i
+
+    def draw(self, i, direction=1):
+        """ Draws frame i of the sequence, played right (direction 1) or left (direction -1). """
+        self.stims[self.frame_index(i, direction)].draw()
+
+    def start_trial(self):
+        pass
+
+    def trial_statistics(self):
+        """ Every frame has its texture, so there are no cache statistics. """
+        return {}
+
+    def close(self):
+        pass
+
+
+class StreamingFramePlayer(FramePlayer):
+    """
+    Frame player for high resolution spheres that does not keep every frame as a texture.
+    Only the cache_size most recently drawn frames have a texture (least recently used ones
+    are recycled), and a background thread reads and decodes the frames that come up next
+    in the playing direction. This keeps the memory use constant, no matter how many
+    sphere variants or how many frames a sequence has.
+
+    Every frame that is drawn is counted per trial: a hit if it already had a texture or was
+    prefetched, a miss if it had to be read while drawing. Misses of frames that were requested
+    but not decoded in time are also counted as late.
+    """
+
+    def __init__(self, win, frames, units='deg', size=None, cache_size=32, prefetch=8, autoLog=True):
+        """
+        Parameters
+        ----------
+        cache_size : int
+            Number of frames that are kept as textures
+        prefetch : int
+            Number of upcoming frames that are read ahead in the background
+        autoLog : bool
+            If the textures log their creation and every new image to psychopy's log
+        """
+        self.win = win
+        self.frames = frames
+        self.nr_of_frames = len(frames)
+        self.units = units
+        self.size = size
+        self.autoLog = autoLog
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+
+        self.stims = OrderedDict()  # frame index -> ImageStim, least recently used first
+        self.prefetched = {}  # frame index -> decoded image, filled by the prefetch thread
+        self.pending = set()  # frame indices that were requested but are not decoded yet
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.last_index = None
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_late = 0
+
+        self.prefetch_thread = threading.Thread(target=self.prefetch_frames, daemon=True)
+        self.prefetch_thread.start()
+
+    def load_image(self, index):
+        # copying the frame reads it from disk if it is memory-mapped
+        return frame_image(np.array(self.frames[index]))
+
+    def prefetch_frames(self):
+        """ Runs in the background thread and decodes the requested frames. """
+        while True:
+            index = self.requests.get()
+            if index is None:
+                break
+            with self.lock:
+                if index in self.prefetched:
+                    self.pending.discard(index)
+                    continue
+            image = self.load_image(index)
+            with self.lock:
+                self.pending.discard(index)
+                self.prefetched[index] = image
+                # don't let frames pile up that were never drawn (e.g. after a direction change)
+                while len(self.prefetched) > 2*self.prefetch:
+                    self.prefetched.pop(next(iter(self.prefetched)))
+
+    def get_stim(self, index):
+        """ Returns the texture of a frame, uploading it into the least recently used one if needed. """
+        stim = self.stims.get(index)
+        if stim is not None:
+            self.stims.move_to_end(index)
+            self.n_hits += 1
+            return stim
+
+        with self.lock:
+            image = self.prefetched.pop(index, None)
+            late = index in self.pending
+        if image is None:
+            # not prefetched, it is read while the frame is drawn
+            image = self.load_image(index)
+            self.n_misses += 1
+            self.n_late += late
+        else:
+            self.n_hits += 1
+
+        if len(self.stims) < self.cache_size:
+            stim = visual.ImageStim(self.win, image=image, units=self.units, size=self.size, autoLog=self.autoLog)
+        else:
+            _, stim = self.stims.popitem(last=False)
+            stim.image = image
+        self.stims[index] = stim
+        return stim
+
+    def draw(self, i, direction=1):
+        index = self.frame_index(i, direction)
+        self.get_stim(index).draw()
+
+        # a frame is shown for several flips, only ask for the next frames when it changes
+        if index != self.last_index:
+            self.last_index = index
+            for step in range(1, self.prefetch+1):
+                upcoming = self.frame_index(i+step, direction)
+                if upcoming in self.stims:
+                    continue
+                with self.lock:
+                    if upcoming in self.pending or upcoming in self.prefetched:
+                        continue
+                    self.pending.add(upcoming)
+                self.requests.put(upcoming)
+
+    def start_trial(self):
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_late = 0
+
+    def trial_statistics(self):
+        """ Cache hits, misses and late frames of the drawn frames since the trial started. """
+        return {'cache_hits': self.n_hits,
+                'cache_misses': self.n_misses,
+                'late_frames': self.n_late}
+
+    def close(self):
+        """ Stops the prefetch thread. """
+        self.requests.put(None)
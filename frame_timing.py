@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/07/26 10:33:47
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import numpy as np
+
+
+class FlipRecorder(object):
+    """
+    Records the timestamp of every flip, and the sphere frame it showed, in preallocated ring
+    buffers. Recording a flip is a single array assignment, the statistics are only computed at
+    the end of a trial.
+    """
+
+    def __init__(self, monitor_refreshrate, clock, capacity=2**17):
+        """
+        Parameters
+        ----------
+        monitor_refreshrate : float
+            Measured refresh rate of the display in Hz, the expected flip interval is 1/monitor_refreshrate
+        clock : callable
+            Returns the current time in s, in the time base of the window's flip times (e.g. psychopy.core.getTime)
+        capacity : int
+            Number of flips that are kept, older ones are overwritten
+        """
+        self.expected_interval = 1/monitor_refreshrate
+        self.clock = clock
+        self.capacity = capacity
+        self.timestamps = np.empty(capacity)
+        self.sphere_frames = np.empty(capacity, dtype=int)
+        self.n_flips = 0
+        self.trial_start = 0
+
+    def record(self, t, sphere_frame=-1):
+        """ Stores the timestamp (in s) of one flip and the sphere frame it showed (its position in the trial, -1 for none). """
+        self.timestamps[self.n_flips % self.capacity] = t
+        self.sphere_frames[self.n_flips % self.capacity] = sphere_frame
+        self.n_flips += 1
+
+    def on_flip(self, sphere_frame=-1):
+        """
+        Records a flip at the current time, register it with win.callOnFlip before the flip: it is
+        called right after the flip, so the flip counts for the trial that drew it.
+        """
+        self.record(self.clock(), sphere_frame)
+
+    def start_trial(self):
+        self.trial_start = self.n_flips
+
+    def trial_statistics(self):
+        """
+        Statistics of the flips recorded since start_trial was called:
+        - n_flips: number of recorded flips
+        - interval_1/2/3plus: histogram of the flip intervals in refresh periods
+        - dropped_flips: number of refreshes that were missed in total
+        - late_flips: number of flips that came at least one refresh period too late
+        - mean_interval, max_interval: in s
+        - rotation_speed: sphere frames per second that were actually shown, the number of
+          changes of the sphere frame over the time from the first to the last shown frame
+        """
+        first = max(self.trial_start, self.n_flips - self.capacity)
+        recorded = np.arange(first, self.n_flips) % self.capacity
+        timestamps = self.timestamps[recorded]
+        intervals = np.diff(timestamps)
+
+        if len(intervals) == 0:
+            return {'n_flips': len(timestamps), 'interval_1': 0, 'interval_2': 0, 'interval_3plus': 0,
+                    'dropped_flips': 0, 'late_flips': 0, 'mean_interval': np.nan, 'max_interval': np.nan,
+                    'rotation_speed': np.nan}
+
+        refreshes = np.maximum(np.rint(intervals/self.expected_interval), 1).astype(int)
+        # flips at which a new sphere frame appeared
+        sphere_frames = self.sphere_frames[recorded]
+        new_frame = np.flatnonzero((sphere_frames >= 0) & (sphere_frames != np.r_[-1, sphere_frames[:-1]]))
+        rotation_speed = np.nan
+        if len(new_frame) > 1:
+            rotation_speed = (len(new_frame)-1)/(timestamps[new_frame[-1]] - timestamps[new_frame[0]])
+        return {'n_flips': len(timestamps),
+                'interval_1': int(np.sum(refreshes == 1)),
+                'interval_2': int(np.sum(refreshes == 2)),
+                'interval_3plus': int(np.sum(refreshes >= 3)),
+                'dropped_flips': int(np.sum(refreshes - 1)),
+                'late_flips': int(np.sum(refreshes > 1)),
+                'mean_interval': intervals.mean(),
+                'max_interval': intervals.max(),
+                'rotation_speed': rotation_speed}
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/10/04 15:22:47
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+# every sample is time (s), x and y (pix from the centre of the screen, y up like psychopy's 'pix' units)
+SAMPLE_COLUMNS = ['time', 'x', 'y']
+# upper limit of the sample rate (Hz), to bound how far back the fixation window looks in the buffer
+MAX_SAMPLE_RATE = 2000
+TRIAL_SUMS = ['n_samples', 'n_valid', 'distance', 'x', 'y', 'x2', 'y2', 'n_outside']
+
+
+def fixation_statistics(samples, fixation, radius):
+    """
+    Fixation quality of a set of samples: the fraction of valid samples (not in a blink or
+    lost by the tracker), the mean distance of the gaze from the fixation point, the stability
+    (root mean square distance of the gaze from its own mean) and the fraction of the valid
+    samples further than radius from the fixation point. Distances are in pix.
+    """
+    valid = ~np.isnan(samples[:, 1:]).any(axis=1)
+    xy = samples[valid, 1:]
+    distance = np.hypot(xy[:, 0]-fixation[0], xy[:, 1]-fixation[1])
+    return {'n_samples': len(samples),
+            'valid': valid.mean() if len(samples) else np.nan,
+            'distance': distance.mean() if len(xy) else np.nan,
+            'stability': np.sqrt(xy.var(axis=0).sum()) if len(xy) else np.nan,
+            'outside': (distance > radius).mean() if len(xy) else np.nan}
+
+
+class GazeStream(object):
+    """
+    Online fixation monitoring. A background thread takes the new gaze samples from the source
+    (the EyeLink's link or a ReplaySampleSource) every poll_interval and writes them into a
+    fixed-size ring buffer. After every read, fixation_lost is set from the samples of the last
+    window s (a contiguous slice of the buffer): if more than half of the valid ones are outside
+    the fixation radius, or if the eye was lost in all of them.
+    The frame loop only reads this flag, it never waits for the thread.
+
+    The samples of every trial are also added to running sums, so the summary of a trial
+    doesn't depend on how many of its samples are still in the buffer.
+    """
+
+    def __init__(self, source, fixation_radius, window=0.5, capacity=2**14, poll_interval=0.002, fixation=(0, 0)):
+        """
+        Parameters
+        ----------
+        source : PylinkSampleSource or ReplaySampleSource
+            Has a read method that returns the new samples (n x 3, see SAMPLE_COLUMNS)
+        fixation_radius : float
+            Distance from the fixation point in pix up to which the gaze counts as fixating
+        window : float
+            Duration in s of the samples that fixation_lost is computed from
+        capacity : int
+            Number of samples kept in the ring buffer
+        poll_interval : float
+            Time in s between two reads of the source
+        fixation : tuple
+            Position of the fixation dot in pix
+        """
+        self.source = source
+        self.fixation_radius = fixation_radius
+        self.window = window
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.fixation = np.asarray(fixation, dtype=float)
+
+        self.samples = np.full((capacity, len(SAMPLE_COLUMNS)), np.nan)
+        self.n_samples = 0  # written since the start, the newest sample is at (n_samples-1) % capacity
+        self.fixation_lost = False
+
+        self.lock = threading.Lock()  # for the trial sums, which are reset from the main thread
+        self.trial_sums = dict.fromkeys(TRIAL_SUMS, 0.0)
+        self.max_distance = 0.0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        """ Runs in the background thread. """
+        while self.running:
+            self.update()
+            time.sleep(self.poll_interval)
+
+    def update(self):
+        """ Reads the new samples from the source and checks the fixation. """
+        new = self.source.read()
+        if len(new):
+            self.append(new)
+            self.check_fixation()
+
+    def append(self, new):
+        self.add_to_trial(new)
+        # if more samples came in than fit into the buffer, only the newest are kept
+        kept = new[-self.capacity:]
+        positions = (self.n_samples + len(new) - len(kept) + np.arange(len(kept))) % self.capacity
+        self.samples[positions] = kept
+        self.n_samples += len(new)
+
+    def recent(self, duration):
+        """ The samples of the last duration s (by the time of the newest sample), oldest first. """
+        n = min(self.n_samples, self.capacity, int(np.ceil(duration*MAX_SAMPLE_RATE)))
+        end = self.n_samples % self.capacity
+        if n <= end:
+            samples = self.samples[end-n:end]
+        else:
+            samples = np.concatenate([self.samples[end-n:], self.samples[:end]])
+        if n == 0:
+            return samples
+        return samples[np.searchsorted(samples[:, 0], samples[-1, 0] - duration, side='right'):]
+
+    def check_fixation(self):
+        # only what the flag needs, the distance is nan for samples without gaze
+        samples = self.recent(self.window)
+        distance = np.hypot(samples[:, 1]-self.fixation[0], samples[:, 2]-self.fixation[1])
+        n_valid = len(distance) - np.count_nonzero(np.isnan(distance))
+        self.fixation_lost = bool(n_valid == 0 or np.count_nonzero(distance > self.fixation_radius) > n_valid/2)
+
+    def window_statistics(self):
+        """ Fixation quality of the last window s, see fixation_statistics. """
+        return fixation_statistics(self.recent(self.window), self.fixation, self.fixation_radius)
+
+    def add_to_trial(self, new):
+        valid = ~np.isnan(new[:, 1:]).any(axis=1)
+        xy = new[valid, 1:]
+        distance = np.hypot(xy[:, 0]-self.fixation[0], xy[:, 1]-self.fixation[1])
+        with self.lock:
+            sums = self.trial_sums
+            sums['n_samples'] += len(new)
+            sums['n_valid'] += len(xy)
+            sums['distance'] += distance.sum()
+            sums['x'] += xy[:, 0].sum()
+            sums['y'] += xy[:, 1].sum()
+            sums['x2'] += (xy[:, 0]**2).sum()
+            sums['y2'] += (xy[:, 1]**2).sum()
+            sums['n_outside'] += (distance > self.fixation_radius).sum()
+            if len(distance):
+                self.max_distance = max(self.max_distance, distance.max())
+
+    def start_trial(self):
+        """ Starts the sums of a new trial. """
+        with self.lock:
+            self.trial_sums = dict.fromkeys(TRIAL_SUMS, 0.0)
+            self.max_distance = 0.0
+
+    def trial_summary(self):
+        """ Fixation quality of the samples since start_trial, like fixation_statistics. """
+        with self.lock:
+            sums = dict(self.trial_sums)
+            max_distance = self.max_distance
+        n_valid = sums['n_valid']
+        if n_valid == 0:
+            return {'n_samples': int(sums['n_samples']), 'valid': np.nan if sums['n_samples'] == 0 else 0.0,
+                    'distance': np.nan, 'max_distance': np.nan, 'stability': np.nan, 'outside': np.nan}
+        variance = (sums['x2'] + sums['y2'])/n_valid - ((sums['x']/n_valid)**2 + (sums['y']/n_valid)**2)
+        return {'n_samples': int(sums['n_samples']),
+                'valid': n_valid/sums['n_samples'],
+                'distance': sums['distance']/n_valid,
+                'max_distance': max_distance,
+                'stability': np.sqrt(max(variance, 0.0)),
+                'outside': sums['n_outside']/n_valid}
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class PylinkSampleSource(object):
+    """
+    Reads the gaze samples the EyeLink sends over the link while it records (with gaze in
+    'link_sample_data'). The tracker's time is converted to s and the gaze position to pix from
+    the centre of the screen. Samples without a gaze position (blinks) are nan.
+
+    pylink is not thread-safe: the samples are read while holding the lock of the tracker's
+    message queue (see tracker_messages.py), so they never interleave with the messages that are
+    sent or with the calls of the main thread.
+    """
+
+    def __init__(self, tracker, screen_size, lock, max_samples=1000):
+        """
+        Parameters
+        ----------
+        tracker : pylink.EyeLink
+        screen_size : list
+            Width and height of the screen in pix, the EyeLink's gaze coordinates start top left
+        lock : threading.RLock
+            Lock held during every call to the tracker (TrackerMessageQueue.lock)
+        max_samples : int
+            Largest number of samples taken from the link at once
+        """
+        import pylink
+        self.pylink = pylink
+        self.tracker = tracker
+        self.screen_size = screen_size
+        self.lock = lock
+        self.max_samples = max_samples
+
+    def read(self):
+        samples = []
+        # the data of an item has to be taken before the next item, so the lock is held for all of them
+        with self.lock:
+            for _ in range(self.max_samples):
+                item = self.tracker.getNextData()
+                if not item:
+                    break
+                if item != self.pylink.SAMPLE_TYPE:
+                    continue
+                sample = self.tracker.getFloatData()
+                eye = sample.getRightEye() if sample.isRightSample() else sample.getLeftEye()
+                if eye is None:
+                    continue
+                samples.append((sample.getTime()/1000, *eye.getGaze()))
+        samples = np.array(samples, dtype=float).reshape(-1, len(SAMPLE_COLUMNS))
+        xy = samples[:, 1:]
+        xy[xy == self.pylink.MISSING_DATA] = np.nan
+        xy[:, 0] -= self.screen_size[0]/2
+        xy[:, 1] = self.screen_size[1]/2 - xy[:, 1]
+        return samples
+
+
+class ReplaySampleSource(object):
+    """
+    Local stand-in for the EyeLink's link. Plays recorded (see load_samples) or synthetic (see
+    synthetic_gaze) samples in the time of the given clock, starting at the first read: every
+    read returns the samples that are due since the previous one. With loop, the samples
+    start over at the end.
+    """
+
+    def __init__(self, samples, clock, loop=True):
+        """
+        Parameters
+        ----------
+        samples : numpy.ndarray
+            Samples (n x 3, see SAMPLE_COLUMNS), the times counting from 0
+        clock : callable
+            Returns the current time in s
+        """
+        self.samples = np.asarray(samples, dtype=float)
+        self.clock = clock
+        self.loop = loop
+        times = self.samples[:, 0]
+        # one loop lasts until one sample interval after the last sample
+        self.period = times[-1] + (np.median(np.diff(times)) if len(times) > 1 else 0.0)
+        self.start = None
+        self.position = 0  # number of samples played, counting all loops
+
+    def read(self):
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+        n = len(self.samples)
+        if self.loop and self.period > 0:
+            cycle, offset = divmod(now - self.start, self.period)
+        else:
+            cycle, offset = 0, now - self.start
+        end = int(cycle)*n + np.searchsorted(self.samples[:, 0], offset, side='right')
+        played = np.arange(self.position, end)
+        self.position = max(end, self.position)
+        samples = self.samples[played % n]
+        samples[:, 0] += self.start + (played // n)*self.period
+        return samples
+
+
+def synthetic_gaze(rng, duration, rate=500, noise=20, lapse_rate=0.1, lapse_duration=0.3, lapse_distance=300):
+    """
+    Samples of a participant fixating the centre of the screen with gaussian noise (sd noise pix).
+    lapse_rate times per s (at random times) the gaze moves lapse_distance pix away in a random
+    direction for lapse_duration s.
+    """
+    times = np.arange(int(duration*rate))/rate
+    xy = rng.normal(0, noise, (len(times), 2))
+    lapses = rng.uniform(0, duration, rng.poisson(lapse_rate*duration))
+    angles = rng.uniform(0, 2*np.pi, len(lapses))
+    starts = np.searchsorted(times, lapses)
+    ends = np.searchsorted(times, lapses + lapse_duration)
+    for start, end, angle in zip(starts, ends, angles):
+        xy[start:end] += lapse_distance*np.array([np.cos(angle), np.sin(angle)])
+    return np.column_stack([times, xy])
+
+
+def load_samples(path):
+    """ Reads recorded samples from a tsv file with the columns time (s), x and y (pix from the centre). """
+    samples = pd.read_csv(path, sep='\t')[SAMPLE_COLUMNS].to_numpy(dtype=float)
+    samples[:, 0] -= samples[0, 0]
+    return samples
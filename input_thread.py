@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/09/06 09:51:23
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import threading
+import time
+from collections import deque
+
+
+class KeyInputThread(object):
+    """
+    Reads the keyboard in a background thread, so button presses are collected independently of
+    the frame loop. The keyboard (psychopy's Keyboard with the psychtoolbox backend) timestamps
+    press and release in its own event queue, the thread moves every completed press (with
+    press time rt and duration until the release) into a deque as soon as the key is released.
+    The trial only takes the presses that arrived since its last frame out of the deque.
+
+    While the thread runs, the keyboard must not be read anywhere else, use drain instead.
+    """
+
+    def __init__(self, kb, poll_interval=0.001):
+        """
+        Parameters
+        ----------
+        kb : psychopy.hardware.keyboard.Keyboard
+            The keyboard of the session
+        poll_interval : float
+            Time in s between two reads of the keyboard
+        """
+        self.kb = kb
+        self.poll_interval = poll_interval
+        self.presses = deque()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.read_keys, daemon=True)
+        self.thread.start()
+
+    def read_keys(self):
+        """ Runs in the background thread. """
+        while self.running:
+            for key in self.kb.getKeys(waitRelease=True):
+                self.presses.append(key)
+            time.sleep(self.poll_interval)
+
+    def drain(self, keyList=None):
+        """
+        Returns the presses that were released since the last call, in the order of their release.
+        With keyList only the presses of those keys are taken, the others stay queued for a later
+        call (like Keyboard.getKeys).
+        """
+        keys = []
+        kept = []
+        # only the presses that are queued now, the thread may append more in the meantime
+        for _ in range(len(self.presses)):
+            key = self.presses.popleft()
+            if keyList is None or key.name in keyList:
+                keys.append(key)
+            else:
+                kept.append(key)
+        # they were released before the presses the thread appended since, so they go back in front
+        self.presses.extendleft(reversed(kept))
+        return keys
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -12,6 +12,7 @@ import os
 import re
 from datetime import datetime
 from session import RotatingSphereSession
+from dry_run import DryRunSession
 datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
@@ -24,6 +25,11 @@ def main():
     output_dir = './output_data/'+output_str+'_Logs_rotating_sphere'
     settings_file = './settings.yml'
     eyetracker_on = True if sys.argv[3] == "True" else False
+    # 'dry-run' runs the whole session headless with a virtual clock and a simulated participant
+    dry_run = len(sys.argv) > 4 and sys.argv[4] == 'dry-run'
+
+    if dry_run:
+        output_dir = './output_data/dry_run/'+output_str+'_Logs_rotating_sphere'
 
     if not os.path.exists('./output_data'):
         os.mkdir('./output_data')
@@ -33,7 +39,10 @@ def main():
         output_dir = output_dir + datetime.now().strftime('%Y%m%d%H%M%S')
     
     # instantiate and run the session 
-    experiment_session = RotatingSphereSession(output_str, output_dir, settings_file, subject_ID, eyetracker_on)
+    if dry_run:
+        experiment_session = DryRunSession(output_str, output_dir, settings_file, subject_ID)
+    else:
+        experiment_session = RotatingSphereSession(output_str, output_dir, settings_file, subject_ID, eyetracker_on)
     experiment_session.run()
 
 
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/07/12 14:21:36
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def response_timing(delay, response_interval):
+    """
+    Returns 'in_time' if the delay (in s) lies within the response interval, 'invalid'
+    otherwise. Works on single values as well as on arrays.
+    """
+    in_time = (delay >= response_interval[0]) & (delay <= response_interval[1])
+    if np.ndim(in_time) == 0:
+        return 'in_time' if in_time else 'invalid'
+    return np.where(in_time, 'in_time', 'invalid')
+
+
+def trial_table(events, screenticks_per_frame, monitor_refreshrate):
+    """
+    Onset and duration (in s) of every trial of a finished session, sorted by onset.
+    The onset of a trial is the onset of its first logged phase.
+    """
+    is_key = events['key_duration'].notna()
+    phases = events[~is_key]
+    trials = phases.groupby('trial_nr', sort=False).first()
+    trials = pd.DataFrame({'trial_nr': trials.index.astype(int),
+                           'onset': trials['onset'].astype(float).values,
+                           'duration': trials['phase_length'].astype(float).values*screenticks_per_frame/monitor_refreshrate})
+    return trials.sort_values('onset').reset_index(drop=True)
+
+
+def rescore_responses(events, response_interval, screenticks_per_frame, monitor_refreshrate):
+    """
+    Recomputes reaction time, offset delay and their timing validity for all button presses in
+    the unambiguous blocks of a finished session (an events.tsv loaded as DataFrame).
+
+    The trial a press started in is found for all presses at once with a binary search in the
+    sorted trial onsets. The rules are the same as in RSTrial.get_events: a press is logged in the
+    trial in which the key was released. If it started in an earlier trial, the reaction time is
+    relative to the onset of that trial and the offset delay is the release time relative to the
+    onset of the trial it was logged in. Otherwise the offset delay is the press onset relative
+    to the end of the trial.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The unambiguous button press rows with rescored 'reaction_time', 'offset_delay',
+        'onset_delay_timing' and 'offset_delay_timing' columns. Presses logged in a trial
+        without a phase row are left out
+    """
+    trials = trial_table(events, screenticks_per_frame, monitor_refreshrate)
+    onsets = trials['onset'].values
+    durations = trials['duration'].values
+    position = pd.Series(np.arange(len(trials)), index=trials['trial_nr'].values)
+
+    keys = events[events['key_duration'].notna() & (events['block_type'] == 'unambiguous')]
+    logged_trial = position.reindex(keys['trial_nr'].astype(int).values).values
+    # presses in a trial without a logged phase (e.g. when the session was aborted) can't be rescored
+    has_trial = ~np.isnan(logged_trial)
+    keys = keys[has_trial].copy()
+    logged_trial = logged_trial[has_trial].astype(int)
+    press = keys['onset'].astype(float).values
+    release = press + keys['key_duration'].astype(float).values
+
+    press_trial = np.searchsorted(onsets, press, side='right') - 1
+    started_earlier = press_trial < logged_trial
+
+    reaction_time = np.where(started_earlier,
+                             press - onsets[np.clip(logged_trial-1, 0, None)],
+                             press - onsets[logged_trial])
+    offset_delay = np.where(started_earlier,
+                            release - onsets[logged_trial],
+                            press - (onsets[logged_trial] + durations[logged_trial]))
+
+    keys['reaction_time'] = reaction_time
+    keys['offset_delay'] = offset_delay
+    keys['onset_delay_timing'] = response_timing(reaction_time, response_interval)
+    keys['offset_delay_timing'] = response_timing(offset_delay, response_interval)
+    return keys
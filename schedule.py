@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/08/16 15:40:12
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import hashlib
+import os
+import sys
+import numpy as np
+import yaml
+
+opj = os.path.join
+
+# the task settings a schedule depends on, a stored schedule can't be used if one of them changes
+SCHEDULE_SETTINGS = ['Previous percept duration', 'Percept duration jitter', 'Stimulus duration ambiguous',
+                     'Blocks', 'Blocks practice', 'Monitor refreshrate', 'Screentick conversion', 'Frame scheduling']
+RESPONSE_BUTTONS = ['upper_right', 'upper_left']
+
+
+def schedule_key(task_settings, seed):
+    """ Hash of the seed and the settings the schedule depends on. """
+    relevant = {key: task_settings[key] for key in SCHEDULE_SETTINGS}
+    relevant['seed'] = seed
+    return hashlib.sha1(yaml.dump(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def counterbalance(subject_ID):
+    """
+    Start condition (even subjects 0, odd subjects 1) and response button of a subject.
+    Every four consecutive subject IDs go through all combinations of the two.
+    """
+    start_condition = subject_ID % 2
+    response_button = RESPONSE_BUTTONS[(subject_ID // 2) % 2]
+    return start_condition, response_button
+
+
+def block_order(n_blocks, start_condition):
+    """ Block type of every block, they alternate and start condition 1 starts with an ambiguous block. """
+    block_IDs = np.arange(1, n_blocks+1)
+    return np.where((block_IDs + start_condition) % 2 == 0, 'ambiguous', 'unambiguous')
+
+
+def duration_array(rng, task_settings):
+    """
+    Phase durations (in screenticks) of the trials of one unambiguous block.
+
+    If 'Previous percept duration' is a list (in frames), it is shuffled. Otherwise it is the
+    mean percept duration in s: jittered durations are drawn until the block would be longer
+    than 'Stimulus duration ambiguous', and the last trial gets the rest of the block. All
+    durations are drawn at once, as many as fit in the block if each was as short as possible.
+    """
+    monitor_refreshrate = task_settings['Monitor refreshrate']
+    screenticks_per_frame = int(monitor_refreshrate/task_settings['Screentick conversion'])
+    if task_settings['Frame scheduling'] == 'time':
+        # sphere frames scheduled by time don't last a whole number of screenticks
+        screenticks_per_frame = monitor_refreshrate/task_settings['Screentick conversion']
+    previous_percept_duration = task_settings['Previous percept duration']
+
+    if isinstance(previous_percept_duration, list):
+        return rng.permutation(np.round(np.array(previous_percept_duration)*screenticks_per_frame).astype(int))
+
+    nr_frames_total = int(round(task_settings['Stimulus duration ambiguous']*monitor_refreshrate))
+    frames_percept_duration = int(round(previous_percept_duration*monitor_refreshrate))
+    jitter_in_frames = int(task_settings['Percept duration jitter']*monitor_refreshrate)
+    shortest = frames_percept_duration - jitter_in_frames
+    if shortest <= 0:
+        raise ValueError("'Percept duration jitter' has to be smaller than 'Previous percept duration'")
+
+    n_max = nr_frames_total//shortest + 1
+    if jitter_in_frames > 0:
+        durations = frames_percept_duration + rng.integers(-jitter_in_frames, jitter_in_frames, size=n_max)
+    else:
+        durations = np.full(n_max, frames_percept_duration)
+    durations = durations[np.cumsum(durations) <= nr_frames_total]
+    # append whats missing to the last trial
+    return np.append(durations, nr_frames_total - durations.sum())
+
+
+def create_schedule(task_settings, subject_ID, seed):
+    """
+    Schedule of one subject: counterbalancing, block order and the phase durations of all
+    unambiguous blocks (practice first). The random generator is seeded with the seed and the
+    subject ID, so the same subject always gets the same schedule.
+    """
+    rng = np.random.default_rng([seed, subject_ID])
+    start_condition, response_button = counterbalance(subject_ID)
+    block_types = block_order(task_settings['Blocks'], start_condition)
+    practice_durations = [duration_array(rng, task_settings) for _ in range(task_settings['Blocks practice'])]
+    block_durations = [duration_array(rng, task_settings) for _ in range(np.sum(block_types == 'unambiguous'))]
+    return {'subject_ID': subject_ID,
+            'seed': seed,
+            'key': schedule_key(task_settings, seed),
+            'start_condition': start_condition,
+            'response_button': response_button,
+            'block_types': block_types,
+            'practice_durations': practice_durations,
+            'block_durations': block_durations}
+
+
+def schedule_path(schedule_dir, subject_ID):
+    return opj(schedule_dir, f'sub-{subject_ID:03d}_schedule.npz')
+
+
+def save_schedule(schedule, path):
+    """ Saves a schedule as .npz, the duration arrays of all blocks are stored concatenated with their lengths. """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    arrays = {key: value for key, value in schedule.items() if not key.endswith('_durations')}
+    for key in ['practice_durations', 'block_durations']:
+        arrays[key] = np.concatenate([np.zeros(0, dtype=int), *schedule[key]]).astype(int)
+        arrays[key[:-len('durations')]+'lengths'] = np.array([len(durations) for durations in schedule[key]], dtype=int)
+    np.savez(path, **arrays)
+
+
+def load_schedule(path):
+    """ Loads a schedule saved with save_schedule. """
+    with np.load(path) as arrays:
+        schedule = {'subject_ID': int(arrays['subject_ID']),
+                    'seed': int(arrays['seed']),
+                    'key': str(arrays['key']),
+                    'start_condition': int(arrays['start_condition']),
+                    'response_button': str(arrays['response_button']),
+                    'block_types': arrays['block_types'].astype(str)}
+        for key in ['practice', 'block']:
+            splits = np.cumsum(arrays[key+'_lengths'])[:-1]
+            schedule[key+'_durations'] = np.split(arrays[key+'_durations'], splits) if len(arrays[key+'_lengths']) else []
+    return schedule
+
+
+def subject_schedule(task_settings, subject_ID, seed, schedule_dir):
+    """
+    Loads the schedule file of a subject. If there is none, the schedule is created (with the
+    same result as in the batch) and saved. A file that was made with other settings is not
+    overwritten, since sessions may already have been run with it: create the schedules again
+    with schedule.py, or use another 'Schedule path' for the new settings.
+    """
+    path = schedule_path(schedule_dir, subject_ID)
+    if os.path.exists(path):
+        schedule = load_schedule(path)
+        if schedule['key'] != schedule_key(task_settings, seed):
+            raise ValueError(f"Schedule {path} was made with other settings, create the schedules again "
+                             f"(python schedule.py) or set another 'Schedule path'")
+        return schedule
+    schedule = create_schedule(task_settings, subject_ID, seed)
+    save_schedule(schedule, path)
+    return schedule
+
+
+def generate_schedules(task_settings, subject_IDs, seed, schedule_dir):
+    """ Creates and saves the schedules of all subjects, returns the paths of the files. """
+    paths = []
+    for subject_ID in subject_IDs:
+        path = schedule_path(schedule_dir, subject_ID)
+        save_schedule(create_schedule(task_settings, subject_ID, seed), path)
+        paths.append(path)
+    return paths
+
+
+def main():
+    """
+    Creates the schedules of a range of subjects beforehand: python schedule.py <first ID>-<last ID> [settings.yml]
+    e.g. python schedule.py 1-200
+    """
+    first, last = (int(i) for i in sys.argv[1].split('-'))
+    settings_file = sys.argv[2] if len(sys.argv) > 2 else './settings.yml'
+    with open(settings_file) as f:
+        settings = yaml.safe_load(f)
+    task_settings = settings['Task settings']
+
+    paths = generate_schedules(task_settings, range(first, last+1), task_settings['Schedule seed'], task_settings['Schedule path'])
+    print(f"{len(paths)} schedules written to {task_settings['Schedule path']}")
+
+
+if __name__ == '__main__':
+    main()
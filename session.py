@@ -6,15 +6,30 @@
 @contact :   grossmann.rc@gmail.com
 '''
 
-import numpy as np
+import pandas as pd
 import os
 import re
 from datetime import datetime
-from psychopy import visual
+from psychopy import visual, core, logging
 from psychopy.hardware import keyboard
 from exptools2.core import PylinkEyetrackerSession
-from trial import RSTrial
-import random
+from trial import RSTrial, ContinuousRSTrial
+from stimulus_bundle import load_bundle, source_filenames, SEQUENCES
+from stimulus_catalog import StimulusCatalog
+from sphere_generator import generate_sequence
+from frame_player import FramePlayer, StreamingFramePlayer
+from stimulus_pyramid import deg2pix, pyramid_level
+from event_buffer import EventBuffer
+from session_journal import SessionJournal
+from frame_timing import FlipRecorder
+from schedule import subject_schedule
+from tracker_messages import TrackerMessageQueue
+from analysis import percept_durations
+from input_thread import KeyInputThread
+from structured_log import StructuredLog
+from gaze_stream import GazeStream, PylinkSampleSource
+from columnar_events import save_events, events_path
+from telemetry import Telemetry
 
 opj = os.path.join
 
@@ -38,7 +53,13 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         """
 
         super().__init__(output_str, output_dir, settings_file, eyetracker_on=eyetracker_on)
-    	
+        self.setup_task(subject_ID)
+
+    def setup_task(self, subject_ID):
+        """
+        Reads the task and stimulus settings and creates the stimuli and trials. This is kept apart
+        from __init__ so the dry run (see dry_run.py) can set up the same task without a window.
+        """
         self.subject_ID = subject_ID
         # load task setting from settings.yml file
         self.previous_percept_duration = self.settings['Task settings']['Previous percept duration']
@@ -56,9 +77,15 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         self.monitor_refreshrate = self.settings['Task settings']['Monitor refreshrate']
         self.screentick_conversion = self.settings['Task settings']['Screentick conversion']
         self.test_eyetracker = self.settings['Task settings']['Test eyetracker']
+        self.dropped_flips_tolerance = self.settings['Task settings']['Dropped flips tolerance']
+        self.continuous_playback = self.settings['Task settings']['Continuous playback']
+        self.frame_log_interval = self.settings['Task settings']['Frame log interval']
+        self.frame_scheduling = self.settings['Task settings']['Frame scheduling']
+        self.lean_logging = self.settings['Task settings']['Lean logging']
+        self.columnar_output = self.settings['Task settings']['Columnar output']
 
         if self.settings['Task settings']['Screenshot']==True:
-            self.screen_dir=output_dir+'/'+output_str+'_Screenshots'
+            self.screen_dir=self.output_dir+'/'+self.output_str+'_Screenshots'
             if not os.path.exists(self.screen_dir):
                 os.mkdir(self.screen_dir)
 
@@ -76,19 +103,65 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         self.white_at_front = self.settings['Stimulus settings']['White at front'] 
         self.dot_size_min = self.settings['Stimulus settings']['Dot size min'] 
         self.dot_size_max = self.settings['Stimulus settings']['Dot size max'] 
-
+        self.bundle_path = self.settings['Stimulus settings']['Bundle path']
+        self.stimulus_source = self.settings['Stimulus settings']['Stimulus source']
+        self.frame_cache_size = self.settings['Stimulus settings']['Frame cache size']
+        self.frame_prefetch = self.settings['Stimulus settings']['Frame prefetch']
+        self.fit_to_display = self.settings['Stimulus settings']['Fit to display']
+        # size of the sphere on the screen in pixels, from the monitor settings
+        self.stim_size_pix = deg2pix(self.stim_size, self.settings['monitor']['width'],
+                                     self.settings['monitor']['distance'], self.settings['window']['size'][0])
+        self.fixation_radius_pix = deg2pix(self.settings['Task settings']['Fixation radius'], self.settings['monitor']['width'],
+                                           self.settings['monitor']['distance'], self.settings['window']['size'][0])
 
         # this determines how fast our stimulus images change, so the speed of the rotation 
         self.screenticks_per_frame = int(self.monitor_refreshrate/self.screentick_conversion)
-
-        # randomly choose if the participant responds with the right BUTTON to house or face
-        if random.uniform(1,100) < 50:
-            self.response_button = 'upper_right'
+        # sphere frames per s. Counting flips, the rate changes when the refresh rate is not a multiple
+        # of 'Screentick conversion' (e.g. 144 or 59.94 Hz), scheduled by time it is always the same
+        if self.frame_scheduling == 'time':
+            self.sphere_frame_rate = self.screentick_conversion
+        elif self.frame_scheduling == 'flips':
+            self.sphere_frame_rate = self.monitor_refreshrate/self.screenticks_per_frame
         else:
-            self.response_button = 'upper_left'
+            raise ValueError(f"Unknown frame scheduling '{self.frame_scheduling}', use 'flips' or 'time'")
+        # the refresh rate in the settings only defines the durations, the timing of the flips (scheduling the frames
+        # by time, finding dropped flips) uses the rate exptools measured when the window was opened
+        self.measured_refreshrate = getattr(self, 'actual_framerate', None) or self.monitor_refreshrate
+        self.flip_period = 1/self.measured_refreshrate
+
+        # runtime events and the provenance of the stimuli go to <output>_log.jsonl (see structured_log.py).
+        # With 'Lean logging' the stimuli don't log themselves and psychopy's log only gets warnings
+        self.structured_log = StructuredLog(opj(self.output_dir, self.output_str+'_log.jsonl'), self.clock.getTime,
+                                            self.settings['Task settings']['Log level'])
+        if self.lean_logging and getattr(self, 'logfile', None) is not None:
+            self.logfile.setLevel(logging.WARNING)
+        if abs(self.measured_refreshrate - self.monitor_refreshrate) > 1:
+            print(f"The display runs at {self.measured_refreshrate:.2f}Hz, not at the 'Monitor refreshrate' of {self.monitor_refreshrate}Hz")
+            self.structured_log.warning('refreshrate', measured=self.measured_refreshrate, settings=self.monitor_refreshrate)
+
+        # runtime measurements of every trial, saved in <output>_telemetry.tsv (see telemetry.py).
+        # Without 'Telemetry' no method is wrapped, so it costs nothing
+        self.telemetry = None
+        self.telemetry_log = []
+        if self.settings['Task settings']['Telemetry']:
+            self.telemetry = Telemetry()
+            self.telemetry.instrument(self, 'draw_stimulus', 'draw_stimulus')
+            self.telemetry.instrument(self, 'log_frame', 'log_write')
+            self.telemetry.instrument(self, 'journal_trial', 'log_write')
+            self.telemetry.instrument(self.structured_log, 'flush', 'log_write')
+            self.telemetry.start()
+
+        # the counterbalancing and the durations of the unambiguous trials come from the subject's
+        # schedule file (see schedule.py), it is only created here if it doesn't exist yet
+        self.schedule_seed = self.settings['Task settings']['Schedule seed']
+        self.schedule_path = self.settings['Task settings']['Schedule path']
+        self.schedule = subject_schedule(self.settings['Task settings'], self.subject_ID, self.schedule_seed, self.schedule_path)
+        self.response_button = self.schedule['response_button']
 
         # initialize the keyboard for the button presses
-        self.kb = keyboard.Keyboard()
+        self.kb = self.create_keyboard()
+        # with 'Input thread' the keyboard is read in the background, the trials take the presses from its queue
+        self.input_thread = self.create_input_thread()
 
         # count the subjects responses for each condition
         self.switch_times_mean = 0
@@ -96,9 +169,81 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         self.nr_unambiguous_trials = 0       
         self.phase_names = ["fixation", "stimulus", "response_window"]
 
-        self.create_trials()
+        # button presses are collected here during the trials and added to the global log when saving
+        self.event_buffer = EventBuffer(RSTrial.event_columns)
+        # trial_nr -> (onset, duration), filled when the trials start
+        self.trial_onsets = {}
+
+        # the logged rows are written to a journal after every trial, so a crash doesn't lose the session
+        self.journal = None
+        if self.settings['Task settings']['Write journal']:
+            self.journal = SessionJournal(opj(self.output_dir, self.output_str+'_events.journal'))
+        self.n_journaled_rows = 0
+        self.n_journaled_events = 0
+
+        # messages to the eyetracker are sent from a background thread, so a slow link doesn't hold up the frames
+        self.tracker_flush_timeout = self.settings['Task settings']['Tracker flush timeout']
+        self.tracker_messages = None
+        if self.eyetracker_on:
+            self.tracker_messages = self.create_tracker_messages()
+            self.tracker = self.tracker_messages
+
+        # with 'Gaze stream' the gaze samples are monitored while recording, the trials count the flips without fixation
+        self.gaze_stream = self.create_gaze_stream()
+        self.gaze_log = []
+
+        # the trials that show a sphere either play it in one phase or have one phase per sphere frame,
+        # scheduling the frames by time only works within one phase
+        self.sphere_trial = ContinuousRSTrial if self.continuous_playback or self.frame_scheduling == 'time' else RSTrial
+        # the sphere frames shown by continuous trials, every 'Frame log interval' frames
+        self.frame_log = EventBuffer({'trial_nr': int, 'sphere_frame': int, 'frame': int, 'onset': float,
+                                      'target_onset': float, 'delay': float})
+
+        # timestamps of all flips, summarized at the end of every trial
+        self.flip_recorder = FlipRecorder(self.measured_refreshrate, self.tracker_clock)
+        self.frame_timing = []
+
+        # the stimuli are created first, so every trial can hold on to the sphere it shows
         self.create_stimuli()
+        self.create_trials()
+
+    def create_keyboard(self):
+        return keyboard.Keyboard()
 
+    def create_input_thread(self):
+        if not self.settings['Task settings']['Input thread']:
+            return None
+        return KeyInputThread(self.kb, self.settings['Task settings']['Input poll interval'])
+
+    def get_keys(self, keyList=None):
+        """ The button presses that were released since the last call (see KeyInputThread). """
+        if self.input_thread is not None:
+            return self.input_thread.drain(keyList)
+        return self.kb.getKeys(keyList=keyList, waitRelease=True)
+
+    def create_tracker_messages(self):
+        return TrackerMessageQueue(self.tracker, self.tracker_clock, self.settings['Task settings']['Tracker backlog'])
+
+    def create_gaze_stream(self):
+        if not (self.eyetracker_on and self.settings['Task settings']['Gaze stream']):
+            return None
+        # the samples are read under the same lock as the messages are sent, pylink is not thread-safe
+        source = PylinkSampleSource(self.tracker_messages.tracker, self.settings['window']['size'], self.tracker_messages.lock)
+        return GazeStream(source, self.fixation_radius_pix, self.settings['Task settings']['Gaze window'])
+
+    def fixation_lost(self):
+        """ If the gaze left the fixation dot (see GazeStream), it only reads a flag and is called every flip. """
+        return self.gaze_stream is not None and self.gaze_stream.fixation_lost
+
+    def start_recording_eyetracker(self):
+        super().start_recording_eyetracker()
+        # the samples only come over the link while the tracker records
+        if self.gaze_stream is not None:
+            self.gaze_stream.start()
+
+    def tracker_clock(self):
+        """ Time base of the tracker message stamps, the same as the flip times of the window. """
+        return core.getTime()
 
     def create_trials(self):
         """
@@ -113,20 +258,20 @@ class RotatingSphereSession(PylinkEyetrackerSession):
 
         # define which condition starts (equal subjects are 0, unequal 1)
         # either start with ambiguous or unambiguous 
-        self.start_condition = 0 if self.subject_ID % 2 == 0 else 1
+        self.start_condition = self.schedule['start_condition']
 
         # create the phase array for the ambiguous condition (same in all ambiguous blocks)
-        nr_phases_ambig = int(self.stim_dur_ambiguous*self.monitor_refreshrate/self.screenticks_per_frame)
+        nr_phases_ambig = self.nr_sphere_frames(self.stim_dur_ambiguous*self.monitor_refreshrate)
         phase_durations_ambiguous = [self.screenticks_per_frame]*nr_phases_ambig
         ambig_last_frame_previous = nr_phases_ambig%self.nr_of_frames
 
         # add practice blocks beforehand 
         for i in range(self.n_practice_blocks):
             # one ambiguous first
-            self.practice_blocks.append([RSTrial(self, 0, 0, 'ambiguous_practice', 'ambiguous_practice', phase_durations_ambiguous, 'frames', 0)])
+            self.practice_blocks.append([self.sphere_trial(self, 0, 0, 'ambiguous_practice', 'ambiguous_practice', phase_durations_ambiguous, 'frames', 0)])
             # then one unambiguous
 
-            unambiguous_practice_durations = self.create_duration_array()
+            unambiguous_practice_durations = self.schedule['practice_durations'][i]
             unambiguous_practice_block = self.create_unambiguous_block(unambiguous_practice_durations, i, 'unambiguous_practice')
             self.practice_blocks.append(unambiguous_practice_block)
         
@@ -142,28 +287,26 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         self.trial_list.append(RSTrial(self, 0, block_ID, 'break', 'break', [0, self.getready_duration*self.monitor_refreshrate], 'frames', 0))
             
         # now start adding the real blocks 
-        for i in range(self.n_blocks):
+        for i, block_type in enumerate(self.schedule['block_types']):
             # we start counting with 1 because the blocks with ID 0 are breaks!
 
             block_ID = i + 1
 
             # even subjects start with rivarly, odd with unambiguous
-            if (block_ID + self.start_condition) % 2 == 0:
+            if block_type == 'ambiguous':
                 block_ID_ambiguous += 1
-                block_type = 'ambiguous'
                 trial_type = 'ambiguous'
                 self.trial_nr += 1
-                self.trial_list.append(RSTrial(self, self.trial_nr, block_ID_ambiguous, block_type, trial_type, phase_durations_ambiguous, 'frames', ambig_last_frame_previous))
+                self.trial_list.append(self.sphere_trial(self, self.trial_nr, block_ID_ambiguous, block_type, trial_type, phase_durations_ambiguous, 'frames', ambig_last_frame_previous))
                 self.trial_nr += 1
                 self.trial_list.append(RSTrial(self, self.trial_nr, block_ID_ambiguous, block_type, 'break', [self.break_duration*self.monitor_refreshrate, self.getready_duration*self.monitor_refreshrate], 'frames', 0))
                 
 
             else:
-                block_type = 'unambiguous'
                 block_ID_unambig += 1
-                # create the phase duration array 
+                # the phase duration array of the block
                 # total duration should add up to 120s for all unambiguous blocks
-                stim_dur_unambiguous = self.create_duration_array()
+                stim_dur_unambiguous = self.schedule['block_durations'][block_ID_unambig-1]
                 self.nr_unambiguous_trials = self.nr_unambiguous_trials + len(stim_dur_unambiguous)
                 unambiguous_block = self.create_unambiguous_block(stim_dur_unambiguous, block_ID_unambig, block_type)
                 
@@ -171,79 +314,123 @@ class RotatingSphereSession(PylinkEyetrackerSession):
                 self.trial_list = [*self.trial_list, *unambiguous_block]
                 self.trial_nr += 1
                 self.trial_list.append(RSTrial(self, self.trial_nr, block_ID_unambig, block_type, 'break', [self.break_duration*self.monitor_refreshrate, self.getready_duration*self.monitor_refreshrate], 'frames', 0))
-                
-                     
+
+        # make sure the rotation continues smoothly from trial to trial before anybody sits in front of the screen
+        for block in [*self.practice_blocks, self.trial_list]:
+            self.check_rotation_continuity(block)
+
+    def nr_sphere_frames(self, screenticks):
+        """ Number of sphere frames shown in a stimulus of the given duration (in screenticks). """
+        if self.frame_scheduling == 'time':
+            return int(round(screenticks/self.monitor_refreshrate*self.sphere_frame_rate))
+        return int(screenticks/self.screenticks_per_frame)
+
+    def check_rotation_continuity(self, trials):
+        """
+        Checks that every unambiguous trial continues the rotation where the previous trial of
+        the same block ended: its first frame has to be the next frame after the last frame of
+        the previous trial, in the direction of the new trial, so no frame is skipped.
+        """
+        previous = None
+        for trial in trials:
+            if trial.player is None or len(trial.frame_schedule) == 0:
+                continue
+            if (previous is not None and previous.player is trial.player and
+                    previous.block_type == trial.block_type and previous.block_ID == trial.block_ID):
+                last_frame = previous.player.frame_index(previous.frame_schedule[-1], previous.direction)
+                first_frame = trial.player.frame_index(trial.frame_schedule[0], trial.direction)
+                step = ((first_frame - last_frame)*trial.direction) % self.nr_of_frames
+                if step != 1:
+                    raise ValueError(f"Rotation of trial {trial.trial_nr} ({trial.trial_type}) starts at frame {first_frame}, "
+                                     f"but trial {previous.trial_nr} ({previous.trial_type}) ended at frame {last_frame}")
+            previous = trial
 
 
     def create_stimuli(self):
 
         # here we load the images that were produced in the MATLAB code 
-        self.fixation_dot = visual.ImageStim(self.win, image=self.path_to_stim+'FixDot.bmp',  units='deg', size=self.fixation_dot_size)
+        # every stimulus logs its creation (and every change) to psychopy's log, unless logging is lean
+        autoLog = not self.lean_logging
+        self.fixation_dot = visual.ImageStim(self.win, image=self.path_to_stim+'FixDot.bmp',  units='deg', size=self.fixation_dot_size, autoLog=autoLog)
 
         # load a stimulus that can test the eye tracking data 
-        dots = [visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[-250,-250]),
-                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[250,-250]),
-                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[250,250]),
-                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[-250,250])]
+        dots = [visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[-250,-250], autoLog=autoLog),
+                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[250,-250], autoLog=autoLog),
+                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[250,250], autoLog=autoLog),
+                visual.Circle(self.win, lineColor='red', units='pix', size=70, pos=[-250,250], autoLog=autoLog)]
 
         self.eye_tracking_test = dots
 
         # Stimulus text for the break
-        self.break_stim = visual.TextStim(self.win, text="Break")
-        
-        # save the globe stimuli in different lists, since one rotation consists out of 190 images
-        self.ambiguous_stim_list = []
-        self.unambiguous_stim_list_right = []
-        self.unambiguous_stim_list_left = []
-
-        # we have a certain number of frames that make up one rotation of the sphere
-        for i in range(self.nr_of_frames):
-            filename_amb = f'Amb_{self.stimulus_resolution}x{self.stimulus_resolution}-{self.nr_of_frames}frames-{self.nr_of_dots}dots(size={self.dot_size})_{self.sphere_number_ambiguous}.{i+1}.bmp'
-            filename_unamb_right = f'Contr_Unamb_{self.black_at_back}BB_{self.white_at_back}WB_{self.black_at_front}BF_{self.white_at_front}WF_{self.dot_size_min}-{self.dot_size_max}DS_{self.stimulus_resolution}x{self.stimulus_resolution}-{self.nr_of_frames}frames-{self.nr_of_dots}dots(size={self.dot_size})_{self.sphere_number_unambiguous}.{i+1}.bmp'
-            filename_unamb_left = f'Contr_Unamb_{self.black_at_back}BB_{self.white_at_back}WB_{self.black_at_front}BF_{self.white_at_front}WF_{self.dot_size_min}-{self.dot_size_max}DS_{self.stimulus_resolution}x{self.stimulus_resolution}-{self.nr_of_frames}frames-{self.nr_of_dots}dots(size={self.dot_size})_{self.sphere_number_unambiguous}.{self.nr_of_frames-i}.bmp'
-            
-            self.ambiguous_stim_list.append(visual.ImageStim(self.win, image=self.path_to_stim+filename_amb, units='deg', size=self.stim_size))
-            self.unambiguous_stim_list_right.append(visual.ImageStim(self.win, image=self.path_to_stim+filename_unamb_right, units='deg', size=self.stim_size))
-            # create the left rotation list separately since it takes longer if we do the indices counting backwards later on!
-            self.unambiguous_stim_list_left.append(visual.ImageStim(self.win, image=self.path_to_stim+filename_unamb_left, units='deg', size=self.stim_size))
-
-    def create_duration_array(self):
-            """
-            Function that takes the duration entries from the setting file and constructs the 
-            phase duration (duration of trial and ISI) for all trials. 
-            The jitter is added to the mean percept duration from previous studies. If the jitter is
-            0.1s, a random nr between -0.1 and 0.1 is added. 
-            """
-
-            if isinstance(self.previous_percept_duration, list):
-                print('Use predefined phase durations')
-                phase_durations = [elem*self.screenticks_per_frame for elem in self.previous_percept_duration]
-                np.random.shuffle(phase_durations)
-            else:
-                # while the number is not above the trial duration, generate more trial durations
-                max_duration = self.stim_dur_ambiguous
-                nr_frames_total = max_duration*self.monitor_refreshrate
-                frames_percept_duration = self.previous_percept_duration*self.monitor_refreshrate
-                jitter_in_frames = int(self.percept_jitter*self.monitor_refreshrate)
-                current_duration = 0 
-                phase_durations = []
-                while True:
-                    percept_duration = frames_percept_duration + random.randrange(-jitter_in_frames, jitter_in_frames)
-                    current_duration = np.array(phase_durations).sum() + percept_duration
-                    if current_duration > nr_frames_total:
-                        break
-                    
-                    phase_durations.append(percept_duration)
-                    
-                current_duration = np.array(phase_durations).sum()
-                duration_difference = nr_frames_total - current_duration
-                # append whats missing to the last trial
-                phase_durations.append(duration_difference)
-            
-            print("durations unambiguous block:", np.array(phase_durations).sum(), "and length:", len(phase_durations))
-            print(phase_durations)
-            return phase_durations
+        self.break_stim = visual.TextStim(self.win, text="Break", autoLog=autoLog)
         
+        # the stimulus directory is indexed once for both sequences, and all their frames have to exist
+        # before the first one is loaded
+        self.catalog = None
+        if self.stimulus_source == 'bitmaps':
+            self.catalog = StimulusCatalog(self.settings['Stimulus settings']['Stimulus path'], self.bundle_path)
+            for sequence in SEQUENCES:
+                source_filenames(self.settings['Stimulus settings'], sequence, self.bundle_path, self.catalog)
+
+        # one player per sequence, the left rotation plays the unambiguous sequence backwards
+        self.ambiguous_player = self.create_player('ambiguous')
+        self.unambiguous_player = self.create_player('unambiguous')
+
+    def create_player(self, sequence):
+        """
+        Creates the frame player of a sequence. If 'Frame cache size' is smaller than the number
+        of frames, the frames are streamed from disk instead of all being loaded beforehand.
+        """
+        frames = self.load_display_frames(sequence)
+        if 0 < self.frame_cache_size < self.nr_of_frames:
+            return StreamingFramePlayer(self.win, frames, units='deg', size=self.stim_size,
+                                        cache_size=self.frame_cache_size, prefetch=self.frame_prefetch,
+                                        autoLog=not self.lean_logging)
+        return FramePlayer(self.win, frames, units='deg', size=self.stim_size, autoLog=not self.lean_logging)
+
+    def load_display_frames(self, sequence):
+        """
+        The frames of a sequence as they are turned into textures. With 'Fit to display' they are
+        downsampled to the size the sphere has on the screen (see stimulus_pyramid.py), so the
+        textures are not larger than what is shown.
+        """
+        frames = self.load_sequence(sequence)
+        display_frames = frames
+        if self.fit_to_display:
+            display_frames = pyramid_level(frames, self.stim_size_pix, self.bundle_path)
+        self.log_provenance(sequence, frames, display_frames)
+        return display_frames
+
+    def log_provenance(self, sequence, frames, display_frames):
+        """ One entry per sequence in the structured log, with where its frames came from and their size. """
+        provenance = {'sequence': sequence,
+                      'source': self.stimulus_source,
+                      'file': getattr(frames, 'filename', None),
+                      'shape': list(frames.shape),
+                      'display_file': getattr(display_frames, 'filename', None),
+                      'display_shape': list(display_frames.shape)}
+        if self.stimulus_source == 'bitmaps':
+            filenames = source_filenames(self.settings['Stimulus settings'], sequence, self.bundle_path, self.catalog)
+            provenance.update({'stimulus_path': self.path_to_stim,
+                               'bitmaps': len(filenames),
+                               'first_bitmap': filenames[0],
+                               'last_bitmap': filenames[-1]})
+        self.structured_log.info('sequence', **provenance)
+
+    def load_sequence(self, sequence):
+        """
+        Returns the frames (frames x height x width) of one full right rotation of the sphere.
+        Depending on the 'Stimulus source' setting they are either the MATLAB bitmaps, packed into
+        one memory-mapped array (see stimulus_bundle.py), or rendered by sphere_generator.py.
+        """
+        stim_settings = self.settings['Stimulus settings']
+        if self.stimulus_source == 'generated':
+            return generate_sequence(stim_settings, sequence, self.bundle_path)
+        elif self.stimulus_source == 'bitmaps':
+            return load_bundle(stim_settings, sequence, self.bundle_path, self.catalog)
+        else:
+            raise ValueError(f"Unknown stimulus source '{self.stimulus_source}', use 'bitmaps' or 'generated'")
+
     def create_unambiguous_block(self, stim_duration_list, block_ID_unambig, block_type):
         '''
         This function creates a list full of left and right rotation unambiguous trials.
@@ -251,7 +438,6 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         '''
         # the block will start at the beginning of the total frames of the stimulus
         last_frame_previous = 0 
-        dummy = 0 # need this to add the previous last frame from the trial before
         block_list = [] # this is where we store the trials prior to concatenating them to the suitable trial list
 
         # the durations should determine the switch between left and right rotation
@@ -260,47 +446,242 @@ class RotatingSphereSession(PylinkEyetrackerSession):
             trial_type = 'right' if self.trial_nr % 2 == 0 else 'left'
 
             # create the phase durations depending on the duration of the stimulus
-            nr_phases_unambig = int(stim_duration/self.screenticks_per_frame)
+            nr_phases_unambig = self.nr_sphere_frames(stim_duration)
             phase_durations_unambiguous = [self.screenticks_per_frame]*nr_phases_unambig
-            
-            # the number of phases also tell us which image was the last one, so that
-            # the next rotation can start from there
-            last_frame_previous = (last_frame_previous+dummy)%self.nr_of_frames
-            if trial_type == 'right':
-                last_frame_previous = self.nr_of_frames - last_frame_previous 
-            elif trial_type == 'left':
-                last_frame_previous = abs(last_frame_previous - self.nr_of_frames)
             self.trial_nr += 1 
-            block_list.append(RSTrial(self, self.trial_nr, block_ID_unambig, block_type, trial_type, phase_durations_unambiguous,'frames', last_frame_previous))
-            # save old value and update new one
-            dummy = last_frame_previous
-            last_frame_previous = nr_phases_unambig
+            block_list.append(self.sphere_trial(self, self.trial_nr, block_ID_unambig, block_type, trial_type, phase_durations_unambiguous,'frames', last_frame_previous))
+
+            # the number of phases also tell us which image was the last one (last_frame_previous + nr_phases_unambig
+            # in the direction of this trial). The next trial turns the other way, it starts one frame before that
+            # image, so its count starts at the mirrored position
+            last_frame_previous = (self.nr_of_frames - 1 - (last_frame_previous + nr_phases_unambig)) % self.nr_of_frames
 
         return block_list
 
+    def stimulus_for(self, block_type, trial_type):
+        """
+        Returns the frame player and the direction (1 right, -1 left) of a trial,
+        or (None, 0) if the trial doesn't show a sphere.
+        """
+        if trial_type == 'break':
+            return None, 0
+        elif re.match(r"(ambiguous)(.*)", block_type):
+            return self.ambiguous_player, 1
+        elif re.match(r"(unambiguous)(.*)", block_type):
+            # left makes the index count backwards and starts from the end when finished
+            return self.unambiguous_player, -1 if trial_type == 'left' else 1
+        return None, 0
+
+    def log_phase(self, trial, phase=None):
+        """ Adds the row of a phase of the trial to the global log (exptools' Trial.log_phase_info) and returns its onset. """
+        super(RSTrial, trial).log_phase_info(phase=phase)
+        return self.global_log['onset'].iloc[-1]
+
+    def log_length(self):
+        """ Number of phase rows that were logged so far. """
+        return self.global_log.shape[0]
+
     def draw_stimulus(self, phase):
         """
         Depending on what phase we are in, this function draws the apropriate stimulus.
+        In trials that show a sphere, phase is the position in the trial's frame schedule
+        (one phase per sphere frame, or the frame computed by a ContinuousRSTrial).
         """
-        # we want to start there where we ended in the previous rotation
-        frame_index = (self.current_trial.phase+self.current_trial.last_frame_previous+1)%self.nr_of_frames
-        if self.current_trial.trial_type == 'break':
+        trial = self.current_trial
+        if trial.player is not None:
+            # the frame of every phase was computed when the trial was created
+            trial.player.draw(trial.frame_schedule[phase], trial.direction)
+        elif trial.trial_type == 'break':
             # in the break phase there is only the "break" text or fixation dot on a blank screen
             if phase == 0:
                 self.break_stim.draw()
             elif phase == 1:
                 self.fixation_dot.draw()
-        elif re.match(r"(ambiguous)(.*)", self.current_trial.block_type):
-            self.ambiguous_stim_list[frame_index].draw()
-        
-        elif re.match(r"(unambiguous)(.*)", self.current_trial.block_type):
-            if self.current_trial.trial_type=='left':
-                # makes the index count backwards and starts from the end when finished
-                self.unambiguous_stim_list_left[frame_index].draw()
-            else:
-                self.unambiguous_stim_list_right[frame_index].draw()
-        elif self.current_trial.block_type == 'tracking_test':
-            self.eye_tracking_test[int(self.current_trial.trial_type)].draw()
+        elif trial.block_type == 'tracking_test':
+            self.eye_tracking_test[int(trial.trial_type)].draw()
+
+    def run_trial(self, trial):
+        """ Runs one trial and does the bookkeeping at the trial boundaries. """
+        self.current_trial = trial
+        self.current_trial_start_time = self.kb.clock.getTime()
+        self.flip_recorder.start_trial()
+        if trial.player is not None:
+            trial.player.start_trial()
+        if self.gaze_stream is not None:
+            self.gaze_stream.start_trial()
+        if self.telemetry is not None:
+            self.instrument_trial(trial)
+            self.telemetry.start_trial()
+        # the run function is implemented in the parent Trial class, so our Trial inherited it
+        self.current_trial.run()
+        self.log_frame_timing()
+        self.log_gaze()
+        self.journal_trial()
+        # the trials of a block follow each other without a pause (the rotation goes on), so the eyetracker
+        # messages are only waited for after the trials without a sphere (the breaks), in between the backlog is only checked
+        if trial.player is None:
+            self.flush_tracker_messages(trial.trial_nr)
+        elif self.tracker_messages is not None and not self.tracker_messages.flush(0):
+            self.structured_log.debug('tracker_backlog', trial_nr=trial.trial_nr, backlog=len(self.tracker_messages.backlog))
+        # the entries of the trial are handed to the log's writer thread
+        self.structured_log.flush()
+        self.log_telemetry()
+
+    def instrument_trial(self, trial):
+        """ Times the frame loop of a trial: drawing, reading the keys and adding the phases to the global log. """
+        self.telemetry.instrument(trial, 'draw', 'draw')
+        self.telemetry.instrument(trial, 'get_events', 'get_events')
+        self.telemetry.instrument(trial, 'log_phase_info', 'log_write')
+
+    def log_telemetry(self):
+        """ Summarizes the runtime of the trial that just ended, including the writes between the trials. """
+        if self.telemetry is None:
+            return
+        telemetry = {'trial_nr': self.current_trial.trial_nr,
+                     'block_type': self.current_trial.block_type,
+                     'trial_type': self.current_trial.trial_type,
+                     **self.telemetry.trial_summary()}
+        self.structured_log.debug('telemetry', **telemetry)
+        self.telemetry_log.append(telemetry)
+
+    def log_frame_timing(self):
+        """
+        Summarizes the flips of the trial that just ended. Trials with more dropped flips than
+        'Dropped flips tolerance' are flagged, since the sphere did not rotate at the intended speed.
+        """
+        timing = {'trial_nr': self.current_trial.trial_nr,
+                  'block_type': self.current_trial.block_type,
+                  'trial_type': self.current_trial.trial_type,
+                  **self.flip_recorder.trial_statistics(),
+                  'skipped_frames': self.current_trial.skipped_frames}
+        if self.current_trial.player is not None:
+            # texture cache of a StreamingFramePlayer
+            timing.update(self.current_trial.player.trial_statistics())
+        timing['timing_ok'] = timing['dropped_flips'] <= self.dropped_flips_tolerance
+        if not timing['timing_ok']:
+            print(f"Trial {timing['trial_nr']} dropped {timing['dropped_flips']} flips!")
+            self.structured_log.warning('frame_timing', **timing)
+        else:
+            self.structured_log.debug('frame_timing', **timing)
+        self.frame_timing.append(timing)
+
+    def log_gaze(self):
+        """ Summarizes the fixation during the trial that just ended (see GazeStream.trial_summary). """
+        if self.gaze_stream is None:
+            return
+        gaze = {'trial_nr': self.current_trial.trial_nr,
+                'block_type': self.current_trial.block_type,
+                'trial_type': self.current_trial.trial_type,
+                'fixation_lost_flips': self.current_trial.fixation_lost_flips,
+                **self.gaze_stream.trial_summary()}
+        self.structured_log.debug('gaze', **gaze)
+        self.gaze_log.append(gaze)
+
+    def log_frame(self, trial, sphere_frame):
+        """
+        Adds the sphere frame that a continuous trial just showed to the frame log, with the time
+        it should have been shown at (counted from the first flip of the trial at the sphere
+        frame rate) and the delay since then.
+        """
+        frame = trial.player.frame_index(trial.frame_schedule[sphere_frame], trial.direction)
+        onset = self.clock.getTime()
+        target_onset = trial.rotation_onset + sphere_frame/self.sphere_frame_rate
+        self.frame_log.append(len(self.frame_log), {'trial_nr': trial.trial_nr,
+                                                    'sphere_frame': sphere_frame,
+                                                    'frame': frame,
+                                                    'onset': onset,
+                                                    'target_onset': target_onset,
+                                                    'delay': onset - target_onset})
+
+    def journal_trial(self):
+        """
+        Hands the rows that were logged since the last call (phases and button presses) over to the journal.
+        The journal writes them to disk in the background.
+        """
+        if self.journal is None:
+            return
+        # only the new rows and presses are handed over, they are merged in the journal's thread. The rows are a
+        # slice of the global log, exptools only adds rows to it, so they don't change anymore
+        self.journal.append(self.global_log.iloc[self.n_journaled_rows:],
+                            self.event_buffer.snapshot(self.n_journaled_events),
+                            self.n_journaled_rows + self.n_journaled_events)
+        self.n_journaled_rows = self.global_log.shape[0]
+        self.n_journaled_events = len(self.event_buffer)
+
+    def flush_tracker_messages(self, trial_nr=None):
+        """ Waits up to 'Tracker flush timeout' until the queued eyetracker messages are sent, only when nothing moves on the screen. """
+        if self.tracker_messages is None or self.tracker_messages.flush(self.tracker_flush_timeout):
+            return
+        print(f"Eyetracker messages of trial {trial_nr} are still being sent")
+        self.structured_log.warning('tracker_backlog', trial_nr=trial_nr, backlog=len(self.tracker_messages.backlog))
+
+    def close_tracker_messages(self):
+        """ Sends the remaining eyetracker messages, before the recording is stopped. """
+        if self.tracker_messages is None or not self.tracker_messages.running:
+            return
+        if not self.tracker_messages.close():
+            print("Not all eyetracker messages could be sent before closing")
+        statistics = self.tracker_messages.statistics()
+        level = 'warning' if statistics['dropped'] or statistics['failed'] else 'info'
+        self.structured_log.log(level, 'tracker_messages', **statistics)
+        print(f"Eyetracker messages: {statistics['sent']} sent, {statistics['dropped']} dropped, "
+              f"{statistics['failed']} failed, max delay {statistics['max_delay']*1000:.1f}ms")
+
+    def close(self):
+        if self.input_thread is not None:
+            self.input_thread.stop()
+        if self.gaze_stream is not None:
+            self.gaze_stream.stop()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        self.close_tracker_messages()
+        # stops the prefetch threads of streaming players
+        self.ambiguous_player.close()
+        self.unambiguous_player.close()
+        super().close()
+        self.structured_log.close()
+
+    def save_output(self):
+        """ Adds the buffered button presses to the global log before it is saved, and saves the frame timing report. """
+        self.journal_trial()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.global_log = self.event_buffer.merge_into(self.global_log)
+        self.event_buffer.clear()
+
+        # percept durations between the switches in the ambiguous blocks (see analysis.py)
+        percepts = percept_durations(self.global_log, [*self.break_buttons, self.exit_key, 's', 'p'])
+        if len(percepts):
+            self.switch_times_mean = percepts['duration'].mean()
+            self.switch_times_std = percepts['duration'].std()
+            print(f"Percept durations: {self.switch_times_mean:.2f}s +- {self.switch_times_std:.2f}s ({len(percepts)} switches)")
+            self.structured_log.info('percept_durations', mean=self.switch_times_mean, std=self.switch_times_std, switches=len(percepts))
+        super().save_output()
+        self.structured_log.flush()
+
+        # typed copy of the events for the analysis, with the settings of the session
+        if self.columnar_output:
+            save_events(self.global_log, events_path(self.output_dir, self.output_str), self.settings)
+
+        # sparse log of the sphere frames of continuous trials, the onsets are in the time of the events file
+        if len(self.frame_log):
+            self.frame_log.to_dataframe().to_csv(opj(self.output_dir, self.output_str+'_frame_log.tsv'), sep='\t', index=False)
+
+        # fixation quality of every trial, distances are in pix from the fixation dot
+        if self.gaze_log:
+            pd.DataFrame(self.gaze_log).to_csv(opj(self.output_dir, self.output_str+'_gaze.tsv'), sep='\t', index=False)
+
+        # runtime of every trial, durations in ms and memory in MB
+        if self.telemetry_log:
+            pd.DataFrame(self.telemetry_log).to_csv(opj(self.output_dir, self.output_str+'_telemetry.tsv'), sep='\t', index=False)
+
+        # timing report with one row per trial, it can be joined with the events on trial_nr
+        frame_timing = pd.DataFrame(self.frame_timing)
+        frame_timing.to_csv(opj(self.output_dir, self.output_str+'_frame_timing.tsv'), sep='\t', index=False)
+        if len(frame_timing):
+            print(f"Frame timing: {frame_timing['dropped_flips'].sum()} dropped flips, "
+                  f"{(~frame_timing['timing_ok']).sum()} of {len(frame_timing)} trials flagged")
 
     def  wait_for_yesno(self, text):
         '''
@@ -313,7 +694,7 @@ class RotatingSphereSession(PylinkEyetrackerSession):
         self.win.flip()
         wait_for_key = True
         while wait_for_key:
-            keys = self.kb.getKeys(keyList=['y', 'n'])  
+            keys = self.get_keys(keyList=['y', 'n'])
             for key in keys:
                 if key.name == 'y':
                     answer = True
@@ -325,6 +706,8 @@ class RotatingSphereSession(PylinkEyetrackerSession):
 
     def run(self):
         print("-------------RUN SESSION---------------")
+        if self.input_thread is not None:
+            self.input_thread.start()
         
         if self.eyetracker_on:
             self.calibrate_eyetracker()
@@ -348,8 +731,9 @@ class RotatingSphereSession(PylinkEyetrackerSession):
 
             for block in self.practice_blocks:
                 for trial in block:
-                    self.current_trial = trial
-                    self.current_trial.run()
+                    self.run_trial(trial)
+                # the unambiguous practice blocks don't end with a break trial
+                self.flush_tracker_messages(block[-1].trial_nr)
                 
                 end_practice_text = 'End of practice block!\n' # press 'y' to start real experiment
                 stop_practicing = self.wait_for_yesno(end_practice_text)
@@ -363,10 +747,7 @@ class RotatingSphereSession(PylinkEyetrackerSession):
             
         # self.kb.clock.reset()
         for trial in self.trial_list:
-            self.current_trial = trial 
-            self.current_trial_start_time = self.kb.clock.getTime()
-            # the run function is implemented in the parent Trial class, so our Trial inherited it
-            self.current_trial.run()
+            self.run_trial(trial)
 
         self.display_text('End. \n Well done!:)', keys='space')
         self.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/07/19 16:02:11
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import os
+import pickle
+import queue
+import struct
+import sys
+import threading
+import pandas as pd
+from event_buffer import merge_events
+
+# every record is the length of the pickled rows followed by the rows themselves
+RECORD_HEADER = struct.Struct('<Q')
+
+
+class SessionJournal(object):
+    """
+    Crash-safe journal of the global log. At every trial boundary the session hands over the
+    rows logged during that trial and the button presses, and a background thread merges them
+    (see event_buffer.merge_events) and appends them to a binary journal file. The file is
+    synced to disk every block_size trials and when the journal is closed, so if the experiment
+    crashes at most one block of trials is lost. The draw loop never waits for pandas or the
+    disk: handing over rows only puts them in a queue.
+    """
+
+    def __init__(self, path, block_size=8):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the journal file, new records are appended if it already exists
+        block_size : int
+            Number of trials after which the journal is synced to disk
+        """
+        self.path = path
+        self.block_size = block_size
+        self.records = queue.Queue()
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def append(self, rows, events=None, start=0):
+        """
+        Hands the rows of one trial over to the writer thread.
+
+        Parameters
+        ----------
+        rows : pandas.DataFrame
+            New rows of the global log, they must not be changed afterwards
+        events : tuple
+            Values and positions of the new button presses (see EventBuffer.snapshot), or None
+        start : int
+            Position of the first row, counting the rows and the button presses before it
+        """
+        if len(rows) or (events is not None and len(events[1])):
+            self.records.put((rows, events, start))
+
+    def write_records(self):
+        """ Runs in the background thread and appends the records to the journal file. """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path, 'ab') as f:
+            unsynced = 0
+            while True:
+                record = self.records.get()
+                rows = None
+                if record is not None:
+                    rows, events, start = record
+                    if events is not None:
+                        values, positions = events
+                        rows = merge_events(rows, pd.DataFrame(values, index=positions), start)
+                    data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(RECORD_HEADER.pack(len(data)) + data)
+                    unsynced += 1
+                if unsynced and (rows is None or unsynced >= self.block_size):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    unsynced = 0
+                if rows is None:
+                    break
+
+    def close(self):
+        """ Writes and syncs everything that is still queued and stops the writer thread. """
+        if self.writer.is_alive():
+            self.records.put(None)
+            self.writer.join()
+
+
+def read_journal(path):
+    """
+    Reads all complete records of a journal back into one DataFrame. A record that was only
+    partly written when the experiment crashed is skipped.
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            size, = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                print(f"Skipping incomplete last record of {path}")
+                break
+            chunks.append(pickle.loads(data))
+
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+
+def recover_events(journal_path, events_path=None):
+    """
+    Reconstructs the events file of a crashed session from its journal. The rows are the ones
+    of the global log, without the 'onset_abs' and 'duration' columns that exptools only adds
+    when the session is saved regularly.
+    """
+    if events_path is None:
+        events_path = journal_path.replace('_events.journal', '_events.tsv')
+    events = read_journal(journal_path)
+    events.to_csv(events_path, sep='\t', index=False)
+    print(f"Recovered {len(events)} rows into {events_path}")
+    return events_path
+
+
+def main():
+    """ python session_journal.py <..._events.journal> [events.tsv] """
+    recover_events(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+
+
+if __name__ == '__main__':
+    main()
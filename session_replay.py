@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/10/17 11:14:52
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+import yaml
+from columnar_events import load_events, load_settings, EVENTS_SUFFIX
+from stimulus_bundle import load_bundle
+from stimulus_catalog import StimulusCatalog
+from sphere_generator import generate_sequence
+from stimulus_pyramid import pyramid_level
+
+opj = os.path.join
+
+# the columns of the events the replay needs
+REPLAY_COLUMNS = ['trial_nr', 'onset', 'phase', 'block_type', 'block_ID', 'trial_type', 'phase_length',
+                  'last_frame', 'key_duration']
+
+
+def frame_duration(task_settings):
+    """ Nominal duration of a sphere frame in s, like RotatingSphereSession.sphere_frame_rate. """
+    refreshrate = task_settings['Monitor refreshrate']
+    if task_settings.get('Frame scheduling', 'flips') == 'time':
+        return 1/task_settings['Screentick conversion']
+    return int(refreshrate/task_settings['Screentick conversion'])/refreshrate
+
+
+def sphere_trials(events):
+    """
+    One row per trial that showed a sphere, from the phase rows of the events (not the button
+    presses): the sequence and direction it was played in (as in RotatingSphereSession.stimulus_for),
+    its first phase row and the number of phase rows that were logged.
+    """
+    phases = events[events['key_duration'].isna()]
+    # every trial starts with phase 0, trial numbers repeat in the practice blocks and the breaks
+    trial_id = np.cumsum(phases['phase'].to_numpy(dtype=int) == 0) - 1
+    phases = phases[trial_id >= 0].reset_index(drop=True)
+    trial_id = trial_id[trial_id >= 0]
+    first_row = np.flatnonzero(np.r_[True, trial_id[1:] != trial_id[:-1]]) if len(trial_id) else np.zeros(0, dtype=int)
+    trials = phases.iloc[first_row].reset_index(drop=True)
+    trials['first_row'] = first_row
+    trials['logged_phases'] = np.bincount(trial_id, minlength=len(first_row))
+
+    block_type = trials['block_type'].astype(str)
+    trial_type = trials['trial_type'].astype(str)
+    trials['sequence'] = np.where(block_type.str.match('ambiguous'), 'ambiguous',
+                                  np.where(block_type.str.match('unambiguous'), 'unambiguous', ''))
+    # the left rotation plays the unambiguous sequence backwards
+    trials['direction'] = np.where((trials['sequence'] == 'unambiguous') & (trial_type == 'left'), -1, 1)
+    trials = trials[(trials['sequence'] != '') & (trial_type != 'break')].reset_index(drop=True)
+    return trials, phases['onset'].to_numpy(dtype=float)
+
+
+def replay_session(events, settings):
+    """
+    Reconstructs the sphere frames a session showed, one row per shown frame, for all trials at
+    once. The frames follow from the logged phase_length and last_frame of every trial in the
+    same way the session computes them (see frame_player.frame_schedule and FramePlayer.frame_index):
+
+    - sphere_frame: position in the trial's rotation
+    - frame: frame of the sequence in the direction it is played
+    - stored_frame: index into the stored (right rotation) frames of the sequence
+    - angle: rotation of the sphere in deg (of the right rotation), to align e.g. the gaze to it
+
+    Sessions with one phase per frame have the onset of every frame in the events. Continuous
+    trials only log their onset, the frame onsets are then the target times of the frames (the
+    frame log has the times they were actually shown at).
+
+    Parameters
+    ----------
+    events : pandas.DataFrame
+        The events of the session (events.tsv or load_events)
+    settings : dict
+        The settings of the session (expsettings.yml)
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    nr_of_frames = settings['Stimulus settings']['Number frames']
+    nominal_duration = frame_duration(settings['Task settings'])
+    trials, phase_onsets = sphere_trials(events)
+
+    phase_length = trials['phase_length'].to_numpy(dtype=int)
+    logged = trials['logged_phases'].to_numpy(dtype=int)
+    # one phase per frame, only as many as were shown if the session was aborted during the trial
+    per_phase = (logged > 1) | (logged == phase_length)
+    n_frames = np.where(per_phase, np.minimum(logged, phase_length), phase_length)
+
+    trial = np.repeat(np.arange(len(trials)), n_frames)
+    starts = np.cumsum(n_frames) - n_frames
+    sphere_frame = np.arange(len(trial)) - starts[trial]
+    # as frame_player.frame_schedule, the rotation continues after the last frame of the previous trial
+    frame = (sphere_frame + trials['last_frame'].to_numpy(dtype=int)[trial] + 1) % nr_of_frames
+    direction = trials['direction'].to_numpy(dtype=int)[trial]
+    stored_frame = np.where(direction == 1, frame, nr_of_frames - 1 - frame)
+
+    trial_onset = trials['onset'].to_numpy(dtype=float)[trial]
+    logged_row = np.minimum(trials['first_row'].to_numpy(dtype=int)[trial] + sphere_frame, len(phase_onsets)-1)
+    onset = np.where(per_phase[trial], phase_onsets[logged_row], trial_onset + sphere_frame*nominal_duration)
+    duration = np.full(len(trial), nominal_duration)
+    duration[:-1] = np.diff(onset)
+    # the last frame of a trial is shown until the trial ends
+    ends = starts + n_frames - 1
+    duration[ends[n_frames > 0]] = nominal_duration
+
+    return pd.DataFrame({'trial_nr': trials['trial_nr'].to_numpy()[trial],
+                         'block_type': trials['block_type'].to_numpy()[trial],
+                         'trial_type': trials['trial_type'].to_numpy()[trial],
+                         'block_ID': trials['block_ID'].to_numpy()[trial],
+                         'sequence': trials['sequence'].to_numpy()[trial],
+                         'direction': direction,
+                         'sphere_frame': sphere_frame,
+                         'frame': frame,
+                         'stored_frame': stored_frame,
+                         'angle': stored_frame*360/nr_of_frames,
+                         'onset': onset,
+                         'duration': duration})
+
+
+def load_session(directory):
+    """ The events (the columns the replay needs) and the settings of a session directory. """
+    events = settings = None
+    npz_files = glob.glob(opj(directory, '*'+EVENTS_SUFFIX))
+    if npz_files:
+        try:
+            events = load_events(npz_files[0], REPLAY_COLUMNS)
+            settings = load_settings(npz_files[0])
+        except KeyError as error:
+            # e.g. the npz files of older versions were saved without trial_nr
+            print(f"Reading the events.tsv instead, {error}")
+    if events is None:
+        events_files = glob.glob(opj(directory, '*_events.tsv'))
+        if not events_files:
+            raise FileNotFoundError(f"No events in {directory}")
+        events = pd.read_csv(events_files[0], sep='\t', usecols=REPLAY_COLUMNS)
+    if settings is not None:
+        return events, settings
+    settings_files = glob.glob(opj(directory, '*_expsettings.yml'))
+    if not settings_files:
+        raise FileNotFoundError(f"No settings in {directory}")
+    with open(settings_files[0]) as f:
+        settings = yaml.safe_load(f)
+    return events, settings
+
+
+def render_replay(replay, stim_settings, path, size=None, chunk_size=256):
+    """
+    Writes the frames of a replay to a .npy array (shown frames x height x width, uint8) that can
+    be memory-mapped. The frames are taken from the bundles or the generated spheres of the
+    stimulus settings (the same the session loaded), with size downsampled like 'Fit to display'
+    (see stimulus_pyramid.py) to keep the file small.
+    """
+    frames = {}
+    catalog = None
+    for sequence in replay['sequence'].unique():
+        if stim_settings['Stimulus source'] == 'generated':
+            frames[sequence] = generate_sequence(stim_settings, sequence, stim_settings['Bundle path'])
+        else:
+            if catalog is None:
+                catalog = StimulusCatalog(stim_settings['Stimulus path'], stim_settings['Bundle path'])
+            frames[sequence] = load_bundle(stim_settings, sequence, stim_settings['Bundle path'], catalog)
+        if size is not None:
+            frames[sequence] = pyramid_level(frames[sequence], size, stim_settings['Bundle path'])
+    shape = next(iter(frames.values())).shape[1:] if frames else (0, 0)
+
+    output = np.lib.format.open_memmap(path+'.tmp', mode='w+', dtype=np.uint8, shape=(len(replay), *shape))
+    sequences = replay['sequence'].to_numpy()
+    stored_frame = replay['stored_frame'].to_numpy()
+    for start in range(0, len(replay), chunk_size):
+        chunk = slice(start, start+chunk_size)
+        for sequence, sequence_frames in frames.items():
+            selected = np.flatnonzero(sequences[chunk] == sequence)
+            output[start+selected] = sequence_frames[stored_frame[chunk][selected]]
+    output.flush()
+    del output
+    os.replace(path+'.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+def main():
+    """
+    Replays a finished session: python session_replay.py <session directory> [size]
+    Writes <output>_replay.tsv and, with size (in pix), the shown frames to <output>_replay.npy.
+    """
+    directory = sys.argv[1]
+    events, settings = load_session(directory)
+    replay = replay_session(events, settings)
+    output_str = os.path.basename(os.path.normpath(directory)).split('_Logs')[0]
+    replay.to_csv(opj(directory, output_str+'_replay.tsv'), sep='\t', index=False)
+    print(f"{len(replay)} sphere frames in {replay.groupby(['trial_nr', 'block_type', 'trial_type'], sort=False).ngroups} trials")
+    if len(sys.argv) > 2:
+        frames = render_replay(replay, settings['Stimulus settings'], opj(directory, output_str+'_replay.npy'), int(sys.argv[2]))
+        print(f"Rendered {frames.shape} to {opj(directory, output_str+'_replay.npy')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/06/21 15:40:03
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import hashlib
+import os
+import sys
+import numpy as np
+import yaml
+
+opj = os.path.join
+
+
+def sphere_parameters(stim_settings, sequence):
+    """
+    Collects the parameters of the generator from the 'Stimulus settings' block.
+    The ambiguous sphere has the same contrast and dot size at the front and at the back,
+    and overlapping dots don't show which one is in front. The unambiguous (control) sphere
+    uses the depth dependent values and the dots at the front occlude the ones at the back.
+    """
+    params = {'resolution': stim_settings['Stimulus resolution'],
+              'nr_of_frames': stim_settings['Number frames'],
+              'nr_of_dots': stim_settings['Number dots'],
+              'background': stim_settings['Background grey']}
+
+    if sequence == 'ambiguous':
+        params.update({'sphere_number': stim_settings['Sphere number ambiguous'],
+                       'black_at_back': 0, 'white_at_back': 1,
+                       'black_at_front': 0, 'white_at_front': 1,
+                       'dot_size_min': stim_settings['Dot size'],
+                       'dot_size_max': stim_settings['Dot size'],
+                       'depth_occlusion': False})
+    elif sequence == 'unambiguous':
+        params.update({'sphere_number': stim_settings['Sphere number unambiguous'],
+                       'black_at_back': stim_settings['Black at back'],
+                       'white_at_back': stim_settings['White at back'],
+                       'black_at_front': stim_settings['Black at front'],
+                       'white_at_front': stim_settings['White at front'],
+                       'dot_size_min': stim_settings['Dot size min'],
+                       'dot_size_max': stim_settings['Dot size max'],
+                       'depth_occlusion': True})
+    else:
+        raise ValueError(f"Unknown stimulus sequence '{sequence}', use one of ['ambiguous', 'unambiguous']")
+    return params
+
+
+def render_sphere(resolution, nr_of_frames, nr_of_dots, sphere_number, background,
+                  black_at_back, white_at_back, black_at_front, white_at_front,
+                  dot_size_min, dot_size_max, depth_occlusion=True, chunk_size=16):
+    """
+    Renders all frames of one full rotation of a dot sphere (frames x resolution x resolution, uint8).
+
+    The dots are spread uniformly over the sphere surface (seeded with the sphere number),
+    half of them black and half of them white. The sphere rotates around the vertical axis,
+    the front surface moving to the right with increasing frame number. The dot positions
+    of all frames are projected at once, and then all dots of a chunk of frames are
+    rasterized together as small anti-aliased discs. Contrast and dot size are interpolated
+    linearly between their values at the back and at the front of the sphere.
+
+    Parameters
+    ----------
+    resolution : int
+        Width and height of the frames in pixels
+    background : int
+        Grey value (0-255) of the background
+    black_at_back, white_at_back, black_at_front, white_at_front : float
+        Luminance (0-1) of the black and white dots at the back and at the front
+    dot_size_min, dot_size_max : float
+        Dot diameter relative to the frame width at the back and at the front
+    depth_occlusion : bool
+        If overlapping dots show the one closest to the observer. Otherwise the dot with the
+        lower number is shown, whether it is at the front or at the back, so the occlusion
+        does not give away the direction of rotation
+    chunk_size : int
+        Number of frames that are rasterized in one pass (limits the memory usage)
+    """
+    rng = np.random.default_rng(sphere_number)
+
+    # uniformly distributed points on the unit sphere
+    y = rng.uniform(-1, 1, nr_of_dots)
+    phi = rng.uniform(0, 2*np.pi, nr_of_dots)
+    x = np.sqrt(1 - y**2)*np.cos(phi)
+    z = np.sqrt(1 - y**2)*np.sin(phi)
+    is_white = rng.permutation(nr_of_dots) < nr_of_dots//2
+
+    # rotate and project all dots of all frames at once (frames x dots)
+    angles = 2*np.pi*np.arange(nr_of_frames)/nr_of_frames
+    cos_a, sin_a = np.cos(angles)[:, None], np.sin(angles)[:, None]
+    x_rot = x*cos_a + z*sin_a
+    depth = (z*cos_a - x*sin_a + 1)/2  # 0 at the back, 1 at the front
+
+    diameter = resolution*(dot_size_min + (dot_size_max-dot_size_min)*depth)
+    radius_sphere = resolution*(1 - dot_size_max)/2
+    center_x = resolution/2 + x_rot*radius_sphere
+    center_y = np.broadcast_to(resolution/2 - y*radius_sphere, x_rot.shape)
+
+    black = black_at_back + (black_at_front-black_at_back)*depth
+    white = white_at_back + (white_at_front-white_at_back)*depth
+    luminance = np.where(is_white, white, black)*255
+
+    # every dot is drawn into a small square patch around its center
+    patch = int(np.ceil(resolution*dot_size_max)) + 2
+    offsets = np.arange(patch) - patch//2
+
+    frames = np.empty((nr_of_frames, resolution, resolution), dtype=np.uint8)
+    for start in range(0, nr_of_frames, chunk_size):
+        chunk = slice(start, min(start+chunk_size, nr_of_frames))
+        n_chunk = chunk.stop - chunk.start
+
+        # pixel coordinates covered by the patch of every dot (chunk x dots x patch x patch)
+        px = np.floor(center_x[chunk]).astype(int)[..., None, None] + offsets[None, :]
+        py = np.floor(center_y[chunk]).astype(int)[..., None, None] + offsets[:, None]
+        distance = np.hypot(px + 0.5 - center_x[chunk][..., None, None], py + 0.5 - center_y[chunk][..., None, None])
+        # anti-aliasing: coverage falls off linearly over one pixel at the border of the dot
+        coverage = np.clip(diameter[chunk][..., None, None]/2 + 0.5 - distance, 0, 1)
+        px, py = np.broadcast_to(px, coverage.shape), np.broadcast_to(py, coverage.shape)
+
+        frame_nr = np.broadcast_to(np.arange(n_chunk)[:, None, None, None], coverage.shape)
+        dot_depth = np.broadcast_to(depth[chunk][..., None, None], coverage.shape)
+        dot_luminance = np.broadcast_to(luminance[chunk][..., None, None], coverage.shape)
+        dot_number = np.broadcast_to(np.arange(nr_of_dots)[:, None, None], coverage.shape)
+
+        visible = (coverage > 0) & (px >= 0) & (px < resolution) & (py >= 0) & (py < resolution)
+        pixel = (frame_nr[visible]*resolution + py[visible])*resolution + px[visible]
+        coverage, dot_depth, dot_luminance = coverage[visible], dot_depth[visible], dot_luminance[visible]
+
+        # where dots overlap, the one closest to the observer is shown, or a fixed one if the depth must stay ambiguous
+        priority = -dot_depth if depth_occlusion else dot_number[visible]
+        order = np.lexsort((priority, pixel))
+        pixel = pixel[order]
+        first = np.ones(pixel.shape, dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+
+        images = np.full(n_chunk*resolution*resolution, background, dtype=float)
+        front = order[first]
+        images[pixel[first]] = background*(1-coverage[front]) + dot_luminance[front]*coverage[front]
+        frames[chunk] = np.clip(np.rint(images), 0, 255).reshape(n_chunk, resolution, resolution)
+
+    return frames
+
+
+def parameters_key(params):
+    """ Hash of the generator parameters, used as the name of the cached sequence. """
+    dumped = yaml.safe_dump(params, sort_keys=True)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
+def generate_sequence(stim_settings, sequence, cache_dir):
+    """
+    Returns the frames of a generated sphere sequence as a read-only memory-mapped array
+    (frames x height x width), in the order of the right rotation. The sequence is only
+    rendered if there is no cached version with the same parameters in cache_dir yet.
+    """
+    params = sphere_parameters(stim_settings, sequence)
+    frames_path = opj(cache_dir, f'sphere_{parameters_key(params)[:12]}.npy')
+
+    if not os.path.isfile(frames_path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        print(f"Generating {sequence} sphere with {params}")
+        frames = render_sphere(**params)
+        # write to a temporary file first, so a crash never leaves a half written sequence behind
+        with open(frames_path+'.tmp', 'wb') as f:
+            np.save(f, frames)
+        os.replace(frames_path+'.tmp', frames_path)
+        with open(frames_path[:-4]+'.yml', 'w') as f:
+            yaml.safe_dump({'sequence': sequence, 'parameters': params}, f, sort_keys=False)
+
+    return np.load(frames_path, mmap_mode='r')
+
+
+def main():
+    """ Renders (and caches) both sequences beforehand: python sphere_generator.py [settings.yml] """
+    settings_file = sys.argv[1] if len(sys.argv) > 1 else './settings.yml'
+    with open(settings_file) as f:
+        settings = yaml.safe_load(f)
+    stim_settings = settings['Stimulus settings']
+
+    for sequence in ['ambiguous', 'unambiguous']:
+        frames = generate_sequence(stim_settings, sequence, stim_settings['Bundle path'])
+        print(f"{sequence} sphere: {frames.shape[0]} frames of {frames.shape[1]}x{frames.shape[2]} pixels")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/06/14 10:12:41
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import hashlib
+import os
+import sys
+import numpy as np
+import yaml
+from PIL import Image
+from stimulus_catalog import StimulusCatalog, file_hash, SEQUENCE_CRITERIA, UNAMBIGUOUS_CRITERIA
+
+opj = os.path.join
+
+SEQUENCES = ['ambiguous', 'unambiguous']
+
+
+def sequence_settings(stim_settings, sequence):
+    """
+    The stimulus settings that select the bitmaps of a sequence (the ones the catalog queries
+    with, see StimulusCatalog.sequence_files), and the directory they are in. Other settings
+    (e.g. the stimulus size or the bundle path) don't change the frames of the bundle.
+    """
+    keys = ['Stimulus path', *SEQUENCE_CRITERIA]
+    if sequence == 'ambiguous':
+        keys.append('Sphere number ambiguous')
+    elif sequence == 'unambiguous':
+        keys += ['Sphere number unambiguous', *UNAMBIGUOUS_CRITERIA]
+    else:
+        raise ValueError(f"Unknown stimulus sequence '{sequence}', use one of {SEQUENCES}")
+    return {key: stim_settings[key] for key in keys}
+
+
+def settings_key(stim_settings, sequence):
+    """ Hash of the settings that define a sequence, used to tell bundles of different spheres apart. """
+    dumped = yaml.safe_dump(sequence_settings(stim_settings, sequence), sort_keys=True)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
+def source_filenames(stim_settings, sequence, bundle_dir, catalog=None):
+    """
+    The bitmaps a sequence is compiled from, as found by the stimulus catalog (its index is
+    cached in bundle_dir). This finds the frames whatever prefix the unambiguous sphere was
+    saved with, and skips duplicated files. Pass the catalog if there is one already, creating
+    it lists the whole stimulus directory.
+    """
+    if catalog is None:
+        catalog = StimulusCatalog(stim_settings['Stimulus path'], bundle_dir)
+    return catalog.sequence_files(stim_settings, sequence)
+
+
+def bundle_paths(stim_settings, sequence, bundle_dir):
+    """ Returns the paths of the frame array and of its header for one sequence. """
+    basename = f'{sequence}_{settings_key(stim_settings, sequence)[:12]}'
+    return opj(bundle_dir, basename+'.npy'), opj(bundle_dir, basename+'.yml')
+
+
+def compile_bundle(stim_settings, sequence, bundle_dir, catalog=None):
+    """
+    Decodes all bitmaps of a sequence once and packs them into a single contiguous
+    frames x height x width uint8 array on disk. A small yaml header next to it stores the
+    settings and the size, modification time and hash of every source file, so that we
+    can tell later on if the bundle is still up to date.
+    """
+    if not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    frames_path, header_path = bundle_paths(stim_settings, sequence, bundle_dir)
+    # raises if frames of the sequence are missing, before anything is decoded
+    filenames = source_filenames(stim_settings, sequence, bundle_dir, catalog)
+    sources = [opj(stim_settings['Stimulus path'], filename) for filename in filenames]
+
+    print(f"Compiling {sequence} stimulus bundle from {len(sources)} bitmaps")
+    frames = None
+    source_info = []
+    for i, source in enumerate(sources):
+        with Image.open(source) as image:
+            frame = np.asarray(image.convert('L'))
+        if frames is None:
+            # write to a temporary file first, so a crash never leaves a half written bundle behind
+            frames = np.lib.format.open_memmap(frames_path+'.tmp', mode='w+', dtype=np.uint8,
+                                               shape=(len(sources), *frame.shape))
+        frames[i] = frame
+        stat = os.stat(source)
+        source_info.append({'file': filenames[i],
+                            'size': stat.st_size,
+                            'mtime': stat.st_mtime_ns,
+                            'sha1': file_hash(source)})
+    frames.flush()
+    shape = list(frames.shape)
+    del frames
+    os.replace(frames_path+'.tmp', frames_path)
+
+    header = {'sequence': sequence,
+              'settings key': settings_key(stim_settings, sequence),
+              'Stimulus settings': sequence_settings(stim_settings, sequence),
+              'shape': shape,
+              'sources': source_info}
+    write_header(header_path, header)
+    return frames_path
+
+
+def write_header(header_path, header):
+    with open(header_path+'.tmp', 'w') as f:
+        yaml.safe_dump(header, f, sort_keys=False)
+    os.replace(header_path+'.tmp', header_path)
+
+
+def bundle_is_current(stim_settings, sequence, bundle_dir, catalog=None):
+    """
+    Checks if the bundle on disk still belongs to the current settings and source bitmaps.
+    Files whose size and modification time did not change are trusted, the others are
+    hashed again. If only the modification time changed (e.g. after copying the stimuli to
+    another lab PC) the header is updated, so we only pay for hashing once.
+    """
+    frames_path, header_path = bundle_paths(stim_settings, sequence, bundle_dir)
+    if not (os.path.isfile(frames_path) and os.path.isfile(header_path)):
+        return False
+
+    with open(header_path) as f:
+        header = yaml.safe_load(f)
+    if header.get('settings key') != settings_key(stim_settings, sequence):
+        return False
+
+    filenames = source_filenames(stim_settings, sequence, bundle_dir, catalog)
+    if [info['file'] for info in header['sources']] != filenames:
+        return False
+
+    header_changed = False
+    for info in header['sources']:
+        source = opj(stim_settings['Stimulus path'], info['file'])
+        if not os.path.isfile(source):
+            return False
+        stat = os.stat(source)
+        if stat.st_size == info['size'] and stat.st_mtime_ns == info['mtime']:
+            continue
+        if stat.st_size != info['size'] or file_hash(source) != info['sha1']:
+            return False
+        info['mtime'] = stat.st_mtime_ns
+        header_changed = True
+
+    if header_changed:
+        write_header(header_path, header)
+    return True
+
+
+def load_bundle(stim_settings, sequence, bundle_dir, catalog=None):
+    """
+    Returns the frames of one sequence as a read-only memory-mapped array
+    (frames x height x width). Slicing it does not copy or decode anything, the pages are
+    only read from disk when a frame is actually used. The bundle is (re)compiled
+    first if it is missing or out of date.
+    """
+    if catalog is None:
+        catalog = StimulusCatalog(stim_settings['Stimulus path'], bundle_dir)
+    if not bundle_is_current(stim_settings, sequence, bundle_dir, catalog):
+        compile_bundle(stim_settings, sequence, bundle_dir, catalog)
+    frames_path, _ = bundle_paths(stim_settings, sequence, bundle_dir)
+    return np.load(frames_path, mmap_mode='r')
+
+
+def main():
+    """ Offline compile step: python stimulus_bundle.py [settings.yml] """
+    settings_file = sys.argv[1] if len(sys.argv) > 1 else './settings.yml'
+    with open(settings_file) as f:
+        settings = yaml.safe_load(f)
+    stim_settings = settings['Stimulus settings']
+
+    catalog = StimulusCatalog(stim_settings['Stimulus path'], stim_settings['Bundle path'])
+    for sequence in SEQUENCES:
+        if bundle_is_current(stim_settings, sequence, stim_settings['Bundle path'], catalog):
+            print(f"{sequence} stimulus bundle is up to date")
+        else:
+            compile_bundle(stim_settings, sequence, stim_settings['Bundle path'], catalog)
+
+
+if __name__ == '__main__':
+    main()
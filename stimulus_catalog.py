@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/09/20 11:36:18
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import hashlib
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+import yaml
+
+opj = os.path.join
+
+# the naming scheme of the README, the unambiguous spheres are named Contr_Unamb_ or UnambContr_
+FILENAME_PATTERN = re.compile(
+    r'^(?P<prefix>Amb_|Contr_Unamb_|UnambContr_)'
+    r'(?:(?P<black_at_back>[\d.]+)BB_(?P<white_at_back>[\d.]+)WB_(?P<black_at_front>[\d.]+)BF_'
+    r'(?P<white_at_front>[\d.]+)WF_(?P<dot_size_min>[\d.]+)-(?P<dot_size_max>[\d.]+)DS_)?'
+    r'(?P<resolution>\d+)x\d+-(?P<frames>\d+)frames-(?P<dots>\d+)dots\(size=(?P<dot_size>[\d.]+)\)'
+    r'_(?P<sphere>\d+)\.(?P<frame>\d+)(?P<is_copy> - Kopie)?\.bmp$')
+INT_COLUMNS = ['resolution', 'frames', 'dots', 'sphere', 'frame']
+FLOAT_COLUMNS = ['black_at_back', 'white_at_back', 'black_at_front', 'white_at_front',
+                 'dot_size_min', 'dot_size_max', 'dot_size']
+# settings that select the frames of a sequence, and the catalog column they are compared with
+SEQUENCE_CRITERIA = {'Stimulus resolution': 'resolution', 'Number frames': 'frames',
+                     'Number dots': 'dots', 'Dot size': 'dot_size'}
+UNAMBIGUOUS_CRITERIA = {'Black at back': 'black_at_back', 'White at back': 'white_at_back',
+                        'Black at front': 'black_at_front', 'White at front': 'white_at_front',
+                        'Dot size min': 'dot_size_min', 'Dot size max': 'dot_size_max'}
+
+
+def file_hash(path):
+    """ sha1 of the content of a file, read in chunks. """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def parse_filename(name):
+    """ The parameters of a sphere frame encoded in its filename, or None if it is not named like one. """
+    match = FILENAME_PATTERN.match(name)
+    if match is None:
+        return None
+    info = match.groupdict()
+    info['type'] = 'ambiguous' if info['prefix'] == 'Amb_' else 'unambiguous'
+    info['is_copy'] = info['is_copy'] is not None
+    for column in INT_COLUMNS:
+        info[column] = int(info[column])
+    for column in FLOAT_COLUMNS:
+        info[column] = float(info[column]) if info[column] is not None else np.nan
+    return info
+
+
+class StimulusCatalog(object):
+    """
+    Index of all bitmaps in the stimulus directory. Every file is listed once with the parameters
+    parsed from its name (files of other experiments have no type) and the hash of its content.
+    Files of the same frame with the same content as another file (like the ' - Kopie' copies)
+    point to the file that is used instead in 'duplicate_of'.
+
+    The index is cached in cache_dir. When the catalog is created, the directory is only listed;
+    if no file was added, removed or changed since the last scan the cached index is used, and
+    otherwise only new or changed files are hashed.
+    """
+
+    def __init__(self, stimulus_dir, cache_dir):
+        self.stimulus_dir = stimulus_dir
+        key = hashlib.sha1(os.path.realpath(stimulus_dir).encode('utf-8')).hexdigest()[:12]
+        self.index_path = opj(cache_dir, f'catalog_{key}.tsv')
+        self.header_path = opj(cache_dir, f'catalog_{key}.yml')
+        self.index = self.load()
+
+    def list_files(self):
+        """ Name, size and modification time of every bitmap in the directory, and a signature of all of them. """
+        entries = sorted((entry.name, entry.stat()) for entry in os.scandir(self.stimulus_dir)
+                         if entry.is_file() and entry.name.lower().endswith('.bmp'))
+        files = pd.DataFrame({'file': [name for name, _ in entries],
+                              'size': [stat.st_size for _, stat in entries],
+                              'mtime': [stat.st_mtime_ns for _, stat in entries]})
+        signature = hashlib.sha1(''.join(f'{name}:{stat.st_size}:{stat.st_mtime_ns};' for name, stat in entries).encode('utf-8'))
+        return files, signature.hexdigest()
+
+    def load(self):
+        """ Returns the cached index if the directory did not change since, otherwise scans it. """
+        if not os.path.isdir(self.stimulus_dir):
+            raise FileNotFoundError(f"Stimulus directory {self.stimulus_dir} does not exist")
+        files, signature = self.list_files()
+
+        cached = None
+        if os.path.isfile(self.index_path) and os.path.isfile(self.header_path):
+            with open(self.header_path) as f:
+                header = yaml.safe_load(f)
+            cached = pd.read_csv(self.index_path, sep='\t', keep_default_na=False, na_values=[''])
+            cached['duplicate_of'] = cached['duplicate_of'].fillna('')
+            if header.get('signature') == signature:
+                return cached
+
+        return self.scan(files, signature, cached)
+
+    def scan(self, files, signature, cached=None):
+        """ Parses and hashes the files (reusing the hashes of unchanged files from cached) and saves the index. """
+        hashes = {}
+        if cached is not None:
+            hashes = {(row.file, row.size, row.mtime): row.sha1 for row in cached.itertuples()}
+
+        rows = []
+        for row in files.itertuples():
+            sha1 = hashes.get((row.file, row.size, row.mtime))
+            if sha1 is None:
+                sha1 = file_hash(opj(self.stimulus_dir, row.file))
+            info = parse_filename(row.file) or {'type': None, 'is_copy': False}
+            rows.append({'file': row.file, **info, 'size': row.size, 'mtime': row.mtime, 'sha1': sha1})
+        index = pd.DataFrame(rows, columns=['file', 'type', 'prefix', *INT_COLUMNS, *FLOAT_COLUMNS,
+                                            'is_copy', 'size', 'mtime', 'sha1'])
+
+        # of every set of identical files of the same frame, the original name (not the copy) is used. Identical
+        # frames at different positions are not duplicates, the last frame of a rotation is the same as the first
+        identity = index[['type', *INT_COLUMNS, *FLOAT_COLUMNS]].astype(str).agg('_'.join, axis=1) + '_' + index['sha1']
+        canonical = index.assign(identity=identity).sort_values(['is_copy', 'file']).drop_duplicates('identity')
+        index['duplicate_of'] = identity.map(canonical.set_index('identity')['file'])
+        index.loc[index['duplicate_of'] == index['file'], 'duplicate_of'] = ''
+        print(f"Stimulus catalog: {len(index)} bitmaps in {self.stimulus_dir}, {(index['duplicate_of'] != '').sum()} duplicates")
+
+        self.save(index, signature)
+        return index
+
+    def save(self, index, signature):
+        directory = os.path.dirname(self.index_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        index.to_csv(self.index_path+'.tmp', sep='\t', index=False)
+        os.replace(self.index_path+'.tmp', self.index_path)
+        with open(self.header_path+'.tmp', 'w') as f:
+            yaml.safe_dump({'directory': os.path.realpath(self.stimulus_dir), 'signature': signature}, f)
+        os.replace(self.header_path+'.tmp', self.header_path)
+
+    def query(self, duplicates=False, **criteria):
+        """
+        The sphere frames with the given parameters (column=value, floats are compared with a
+        tolerance), without duplicates unless duplicates is True.
+        """
+        selected = self.index['type'].notna()
+        if not duplicates:
+            selected &= self.index['duplicate_of'] == ''
+        for column, value in criteria.items():
+            if column in FLOAT_COLUMNS:
+                selected &= np.isclose(self.index[column].astype(float), value)
+            else:
+                selected &= self.index[column] == value
+        return self.index[selected]
+
+    def sequence_files(self, stim_settings, sequence):
+        """
+        Filenames of the frames of one sequence in the order of the right rotation, of the files
+        that actually exist.
+        Raises a FileNotFoundError that lists all missing frames if the sequence is not complete.
+        """
+        criteria = {'type': sequence}
+        settings_criteria = dict(SEQUENCE_CRITERIA)
+        if sequence == 'ambiguous':
+            criteria['sphere'] = stim_settings['Sphere number ambiguous']
+        else:
+            criteria['sphere'] = stim_settings['Sphere number unambiguous']
+            settings_criteria.update(UNAMBIGUOUS_CRITERIA)
+        for setting, column in settings_criteria.items():
+            criteria[column] = stim_settings[setting]
+
+        frames = self.query(**criteria).sort_values(['frame', 'is_copy', 'file'])
+        conflicts = frames['frame'].duplicated()
+        if conflicts.any():
+            print(f"{sequence} sequence: frames {sorted(set(frames.loc[conflicts, 'frame']))} exist in different versions, "
+                  f"using {list(frames.loc[frames['frame'].isin(frames.loc[conflicts, 'frame']) & ~conflicts, 'file'])}")
+        frames = frames[~conflicts]
+
+        nr_of_frames = stim_settings['Number frames']
+        missing = sorted(set(range(1, nr_of_frames+1)) - set(frames['frame']))
+        if missing:
+            raise FileNotFoundError(f"The {sequence} sequence with {criteria} in {self.stimulus_dir} is missing "
+                                    f"{len(missing)} of {nr_of_frames} frames: {missing}")
+        return list(frames.loc[frames['frame'] <= nr_of_frames, 'file'])
+
+
+def main():
+    """ Lists the complete sequences in the stimulus path: python stimulus_catalog.py [settings.yml] """
+    settings_file = sys.argv[1] if len(sys.argv) > 1 else './settings.yml'
+    with open(settings_file) as f:
+        settings = yaml.safe_load(f)
+    stim_settings = settings['Stimulus settings']
+
+    catalog = StimulusCatalog(stim_settings['Stimulus path'], stim_settings['Bundle path'])
+    spheres = catalog.query().groupby(['type', 'prefix', 'resolution', 'frames', 'dots', 'dot_size', 'sphere'], dropna=False)
+    print(spheres['frame'].agg(['count', 'min', 'max']).to_string())
+    print(f"{(catalog.index['duplicate_of'] != '').sum()} duplicates, "
+          f"{catalog.index['type'].isna().sum()} other bitmaps")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/09/13 16:08:54
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import hashlib
+import os
+import numpy as np
+from PIL import Image
+
+opj = os.path.join
+
+
+def deg2pix(degrees, monitor_width, monitor_distance, window_width):
+    """
+    Size in pixels of a stimulus of the given size in degrees, computed the same way psychopy
+    does for 'deg' units (without correction for the flat screen).
+
+    Parameters
+    ----------
+    monitor_width : float
+        Width of the screen in cm
+    monitor_distance : float
+        Distance between screen and observer in cm
+    window_width : int
+        Width of the window in pixels
+    """
+    return np.radians(degrees)*monitor_distance*window_width/monitor_width
+
+
+def source_key(frames):
+    """
+    Hash that identifies a sequence. For a memory-mapped sequence (a bundle or a generated
+    sphere) it is based on the file, which is replaced whenever the sequence changes.
+    """
+    filename = getattr(frames, 'filename', None)
+    if filename is not None and os.path.isfile(filename):
+        stat = os.stat(filename)
+        identity = f'{os.path.realpath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    return hashlib.sha1(np.ascontiguousarray(frames).data).hexdigest()
+
+
+def level_path(cache_dir, key, size):
+    return opj(cache_dir, f'level_{key[:12]}_{size}px.npy')
+
+
+def downsample_frames(frames, size, output):
+    """ Resizes every frame so its larger side has size pixels, with a Lanczos filter, into output. """
+    height, width = frames.shape[1:]
+    scale = size/max(height, width)
+    shape = (max(int(round(width*scale)), 1), max(int(round(height*scale)), 1))
+    for i, frame in enumerate(frames):
+        image = Image.fromarray(np.asarray(frame))
+        output[i] = np.asarray(image.resize(shape, Image.LANCZOS, reducing_gap=3.0))
+    return output
+
+
+def pyramid_level(frames, size, cache_dir):
+    """
+    Returns the frames of a sequence at the size (in pixels) they are shown at on the screen.
+    The levels of every sequence are cached in cache_dir, keyed on the sequence and the size,
+    so every size is only computed once. Frames that are not larger than size are returned
+    as they are, they are never upsampled.
+
+    Returns
+    -------
+    numpy.ndarray
+        The frames (frames x height x width), read-only memory-mapped if they were downsampled
+    """
+    size = int(np.ceil(size))
+    if size >= max(frames.shape[1:]):
+        return frames
+
+    frames_path = level_path(cache_dir, source_key(frames), size)
+    if not os.path.isfile(frames_path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        height, width = frames.shape[1:]
+        scale = size/max(height, width)
+        shape = (len(frames), max(int(round(height*scale)), 1), max(int(round(width*scale)), 1))
+        print(f"Downsampling {len(frames)} frames from {width}x{height} to {shape[2]}x{shape[1]} pixels")
+        # write to a temporary file first, so a crash never leaves a half written level behind
+        output = np.lib.format.open_memmap(frames_path+'.tmp', mode='w+', dtype=np.uint8, shape=shape)
+        downsample_frames(frames, size, output)
+        output.flush()
+        del output
+        os.replace(frames_path+'.tmp', frames_path)
+
+    return np.load(frames_path, mmap_mode='r')
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/09/27 10:41:32
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import json
+import os
+import queue
+import sys
+import threading
+import pandas as pd
+
+# same values as the levels of python's logging module
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class StructuredLog(object):
+    """
+    Log of the session with one JSON object per line: time, level, event and the fields of the
+    event. Entries below the level are dropped right away, the others are kept in memory and
+    handed over to a background thread when buffer_size entries have piled up, when the session
+    flushes it between trials, and when it is closed. The thread writes them to the file, so
+    logging never waits for the disk, also not between the trials of a block.
+    """
+
+    def __init__(self, path, clock, level='info', buffer_size=512):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the log file (<output>_log.jsonl), it is overwritten
+        clock : callable
+            Returns the time of an entry in s (e.g. the session clock's getTime)
+        level : str
+            Lowest level that is logged, one of LEVELS
+        buffer_size : int
+            Number of entries that are written at once
+        """
+        if level not in LEVELS:
+            raise ValueError(f"Unknown log level '{level}', use one of {list(LEVELS)}")
+        self.path = path
+        self.clock = clock
+        self.level = LEVELS[level]
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.n_entries = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'w')
+        self.batches = queue.Queue()
+        self.writer = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer.start()
+
+    def log(self, level, event, **fields):
+        if LEVELS[level] < self.level:
+            return
+        self.buffer.append({'time': round(self.clock(), 6), 'level': level, 'event': event, **fields})
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def debug(self, event, **fields):
+        self.log('debug', event, **fields)
+
+    def info(self, event, **fields):
+        self.log('info', event, **fields)
+
+    def warning(self, event, **fields):
+        self.log('warning', event, **fields)
+
+    def error(self, event, **fields):
+        self.log('error', event, **fields)
+
+    def flush(self):
+        """ Hands the buffered entries over to the writer thread. """
+        if not self.buffer or self.file is None:
+            return
+        self.batches.put(self.buffer)
+        self.buffer = []
+
+    def write_batches(self):
+        """ Runs in the background thread until close. """
+        while True:
+            entries = self.batches.get()
+            if entries is None:
+                break
+            # nan (e.g. of a missing reaction time) is written as null, numpy numbers as plain numbers
+            lines = [json.dumps({key: None if isinstance(value, float) and value != value else value
+                                 for key, value in entry.items()}, default=to_builtin)
+                     for entry in entries]
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+            self.n_entries += len(entries)
+
+    def close(self):
+        """ Writes everything that is still buffered or queued and stops the writer thread. """
+        if self.file is None:
+            return
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+        self.file.close()
+        self.file = None
+
+
+def to_builtin(value):
+    """ Converts the numpy values json doesn't know. """
+    # tolist first, item raises for arrays with more than one value
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def read_log(path, event=None):
+    """
+    Reads a structured log into a DataFrame, one row per entry (columns are the fields of all
+    entries). With event, only the entries of that event are returned.
+    """
+    entries = pd.read_json(path, lines=True)
+    if event is not None and len(entries):
+        entries = entries[entries['event'] == event].dropna(axis=1, how='all').reset_index(drop=True)
+    return entries
+
+
+def main():
+    """ Prints the entries of one event: python structured_log.py <output>_log.jsonl [event] """
+    entries = read_log(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(entries.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/10/13 16:05:41
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import gc
+import os
+import time
+import numpy as np
+
+try:
+    # comes with psychopy, without it the resident memory is read from /proc (linux only)
+    import psutil
+except ImportError:
+    psutil = None
+
+# the paths that are timed, see RotatingSphereSession.instrument_trial
+TIMERS = ['draw', 'draw_stimulus', 'get_events', 'log_write']
+
+
+def resident_memory():
+    """ Resident memory of the process in bytes, nan where it can't be read. """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return np.nan
+
+
+class Telemetry(object):
+    """
+    Runtime measurements of the session, summarized per trial: the time spent in the hot paths
+    of the frame loop (draw, get_events, the writes to the logs), the pauses of the garbage
+    collector, the CPU time and the growth of the resident memory.
+
+    The timed methods are wrapped on the instance (see instrument), so nothing of this runs
+    when the telemetry is off. With it on, every call costs two perf_counter reads and a few
+    additions; the memory is only read at the start and end of a trial.
+    """
+
+    def __init__(self):
+        # per timer: number of calls, total and longest duration in s
+        self.timers = {name: [0, 0.0, 0.0] for name in TIMERS}
+        self.gc_start = None
+        self.gc_pauses = [0, 0.0, 0.0]
+        self.gc_collected = 0
+        self.trial_start = None
+        self.cpu_start = None
+        self.rss_start = np.nan
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        gc.callbacks.append(self.gc_callback)
+        self.running = True
+
+    def instrument(self, obj, method, timer):
+        """ Replaces obj.method by a wrapper that adds the duration of every call to timer. """
+        function = getattr(obj, method)
+        if getattr(function, 'instrumented', False):
+            return
+        stats = self.timers[timer]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+        timed.instrumented = True
+        setattr(obj, method, timed)
+
+    def gc_callback(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            pause = time.perf_counter() - self.gc_start
+            self.gc_start = None
+            self.gc_pauses[0] += 1
+            self.gc_pauses[1] += pause
+            self.gc_pauses[2] = max(self.gc_pauses[2], pause)
+            self.gc_collected += info.get('collected', 0)
+
+    def start_trial(self):
+        """ Resets the measurements for a new trial. """
+        for stats in self.timers.values():
+            stats[:] = [0, 0.0, 0.0]
+        self.gc_pauses = [0, 0.0, 0.0]
+        self.gc_collected = 0
+        self.rss_start = resident_memory()
+        self.cpu_start = time.process_time()
+        self.trial_start = time.perf_counter()
+
+    def trial_summary(self):
+        """ The measurements since start_trial, durations in ms and memory in MB. """
+        duration = time.perf_counter() - self.trial_start
+        rss_end = resident_memory()
+        summary = {'duration': duration*1000,
+                   'cpu_time': (time.process_time() - self.cpu_start)*1000}
+        for name, (count, total, longest) in self.timers.items():
+            summary[name+'_calls'] = count
+            summary[name+'_total'] = total*1000
+            summary[name+'_mean'] = total/count*1000 if count else np.nan
+            summary[name+'_max'] = longest*1000
+        summary['gc_pauses'] = self.gc_pauses[0]
+        summary['gc_total'] = self.gc_pauses[1]*1000
+        summary['gc_max'] = self.gc_pauses[2]*1000
+        summary['gc_collected'] = self.gc_collected
+        summary['rss'] = rss_end/2**20
+        summary['rss_growth'] = (rss_end - self.rss_start)/2**20
+        return summary
+
+    def stop(self):
+        if self.gc_callback in gc.callbacks:
+            gc.callbacks.remove(self.gc_callback)
+        self.running = False
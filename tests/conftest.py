@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+import yaml
+
+# the modules of the experiment are in the directory above
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture
+def settings_file(tmp_path):
+    """ Writes settings.yml with changes ({'Section/Key': value}) to tmp_path, with a short session. """
+    def write(**changes):
+        with open(os.path.join(REPO_DIR, 'settings.yml')) as f:
+            settings = yaml.safe_load(f)
+        settings['Task settings'].update({'Break duration': 1, 'Stimulus duration ambiguous': 3})
+        for key, value in changes.items():
+            section, name = key.split('/')
+            settings[section][name] = value
+        path = tmp_path/'settings.yml'
+        with open(path, 'w') as f:
+            yaml.safe_dump(settings, f)
+        return str(path)
+    return write
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+from columnar_events import save_events, load_events
+
+
+def test_trial_nr_round_trip(tmp_path):
+    # after exptools' save_output, trial_nr is the index of the global log
+    log = pd.DataFrame({'trial_nr': [1, 1, 2, 3],
+                        'onset': [0.0, 0.5, 1.0, 1.5],
+                        'event_type': ['right', 'right', 'left', 'break'],
+                        'key_duration': [np.nan, 0.2, np.nan, np.nan]}).set_index('trial_nr')
+    path = str(tmp_path/'sub-001_ses-1_events.npz')
+    save_events(log, path)
+
+    events = load_events(path)
+    assert list(events.columns) == ['trial_nr', 'onset', 'event_type', 'key_duration']
+    np.testing.assert_array_equal(events['trial_nr'], [1, 1, 2, 3])
+    np.testing.assert_array_equal(load_events(path, ['trial_nr'])['trial_nr'], [1, 1, 2, 3])
@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('psychopy')
+from frame_player import frame_image
+
+
+def test_frame_image_is_rgb():
+    # a grey image would become a float texture in psychopy
+    frame = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    image = frame_image(frame)
+    assert image.mode == 'RGB'
+    for channel in np.moveaxis(np.asarray(image), -1, 0):
+        np.testing.assert_array_equal(channel, frame)
@@ -0,0 +1,55 @@
+import numpy as np
+from frame_timing import FlipRecorder
+
+
+class FakeWindow(object):
+    """ Flips at the given times and calls the functions registered with callOnFlip, like psychopy's window. """
+
+    def __init__(self, flip_times):
+        self.flip_times = iter(flip_times)
+        self.now = 0.0
+        self.lastFrameT = 0.0
+        self.on_flip = []
+
+    def callOnFlip(self, function, *args):
+        self.on_flip.append((function, args))
+
+    def flip(self):
+        self.now = next(self.flip_times)
+        on_flip, self.on_flip = self.on_flip, []
+        for function, args in on_flip:
+            function(*args)
+        self.lastFrameT = self.now
+
+
+def run_trial(win, recorder, n_flips, flips_per_frame=2):
+    """ Records the flips of one trial the way RSTrial.draw does, and returns its statistics. """
+    recorder.start_trial()
+    for flip in range(n_flips):
+        win.callOnFlip(recorder.on_flip, flip // flips_per_frame)
+        win.flip()
+    return recorder.trial_statistics()
+
+
+def test_flips_belong_to_the_trial_that_drew_them():
+    period = 1/60
+    # 10 flips per trial, the second trial starts after a pause and drops one refresh after its 4th flip
+    first = np.arange(1, 11)*period
+    second = first[-1] + 0.5 + np.r_[np.arange(4), np.arange(5, 11)]*period
+    win = FakeWindow(np.r_[first, second])
+    recorder = FlipRecorder(60, lambda: win.now)
+
+    statistics = run_trial(win, recorder, 10)
+    np.testing.assert_allclose(recorder.timestamps[:10], first)
+    assert statistics['n_flips'] == 10
+    assert statistics['dropped_flips'] == 0
+    assert np.isclose(statistics['max_interval'], period)
+
+    # the pause between the trials is not counted as dropped flips of the second trial
+    statistics = run_trial(win, recorder, 10)
+    np.testing.assert_allclose(recorder.timestamps[10:20], second)
+    assert statistics['n_flips'] == 10
+    assert statistics['dropped_flips'] == 1
+    assert statistics['interval_2'] == 1
+    # 5 sphere frames, shown from the first to the last one in 9 refreshes
+    assert np.isclose(statistics['rotation_speed'], 4/(9*period))
@@ -0,0 +1,16 @@
+from input_thread import KeyInputThread
+
+
+class Key(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def test_drain_keeps_the_other_keys():
+    thread = KeyInputThread(kb=None)
+    thread.presses.extend(Key(name) for name in ['j', 'space', 'f', 'j'])
+
+    assert [key.name for key in thread.drain(['space'])] == ['space']
+    # the responses are still there, in the order they were released
+    assert [key.name for key in thread.drain()] == ['j', 'f', 'j']
+    assert thread.drain() == []
@@ -0,0 +1,19 @@
+import os
+import pytest
+import yaml
+from conftest import REPO_DIR
+from schedule import subject_schedule, schedule_path, load_schedule
+
+
+def test_stored_schedule_is_not_overwritten(tmp_path):
+    with open(os.path.join(REPO_DIR, 'settings.yml')) as f:
+        task_settings = yaml.safe_load(f)['Task settings']
+    schedule = subject_schedule(task_settings, 7, 2022, str(tmp_path))
+    path = schedule_path(str(tmp_path), 7)
+    assert load_schedule(path)['key'] == schedule['key']
+    # loaded again with the same settings
+    assert subject_schedule(task_settings, 7, 2022, str(tmp_path))['key'] == schedule['key']
+
+    with pytest.raises(ValueError, match='other settings'):
+        subject_schedule({**task_settings, 'Blocks': task_settings['Blocks']+2}, 7, 2022, str(tmp_path))
+    assert load_schedule(path)['key'] == schedule['key']
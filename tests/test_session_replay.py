@@ -0,0 +1,27 @@
+import glob
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('psychopy')
+pytest.importorskip('exptools2')
+
+from columnar_events import EVENTS_SUFFIX, load_events
+from dry_run import dry_run
+from session_replay import load_session, replay_session
+
+
+def test_replay_saved_session(tmp_path, settings_file):
+    session = dry_run('sub-004', 'ses-1', settings_file(**{'Task settings/Columnar output': True}), str(tmp_path/'output'))
+    # the events are read from the npz that Session.save_output wrote
+    npz_files = glob.glob(os.path.join(session.output_dir, '*'+EVENTS_SUFFIX))
+    assert len(npz_files) == 1
+    assert 'trial_nr' in load_events(npz_files[0]).columns
+
+    events, settings = load_session(session.output_dir)
+    replay = replay_session(events, settings)
+
+    sphere_trials = [trial for trial in session.trial_list if trial.player is not None]
+    assert len(replay) == sum(len(trial.frame_schedule) for trial in sphere_trials)
+    np.testing.assert_array_equal(replay['trial_nr'].unique(), [trial.trial_nr for trial in sphere_trials])
+    np.testing.assert_array_equal(replay['frame'], np.concatenate([trial.frame_schedule for trial in sphere_trials]))
@@ -0,0 +1,29 @@
+import os
+import yaml
+import stimulus_bundle
+from conftest import REPO_DIR
+from stimulus_bundle import load_bundle, SEQUENCES
+from stimulus_catalog import StimulusCatalog
+
+
+def test_load_bundle_uses_the_given_catalog(tmp_path, monkeypatch):
+    with open(os.path.join(REPO_DIR, 'settings.yml')) as f:
+        stim_settings = yaml.safe_load(f)['Stimulus settings']
+    # the bitmaps that come with the repository
+    stim_settings.update({'Stimulus path': os.path.join(REPO_DIR, 'stimuli'), 'Stimulus resolution': 190,
+                          'Sphere number unambiguous': 1})
+    created = []
+
+    class CountingCatalog(StimulusCatalog):
+        def __init__(self, *args):
+            created.append(args)
+            super().__init__(*args)
+
+    monkeypatch.setattr(stimulus_bundle, 'StimulusCatalog', CountingCatalog)
+    catalog = CountingCatalog(stim_settings['Stimulus path'], str(tmp_path))
+    for _ in range(2):
+        # compiled the first time, checked the second time
+        for sequence in SEQUENCES:
+            frames = load_bundle(stim_settings, sequence, str(tmp_path), catalog)
+            assert frames.shape[0] == stim_settings['Number frames']
+    assert len(created) == 1
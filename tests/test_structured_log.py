@@ -0,0 +1,15 @@
+import numpy as np
+from structured_log import StructuredLog, read_log
+
+
+def test_numpy_fields(tmp_path):
+    path = str(tmp_path/'sub-001_ses-1_log.jsonl')
+    log = StructuredLog(path, lambda: 1.5)
+    log.info('sequence', shape=np.array([190, 800, 800]), frames=np.int64(190), size=np.float32(0.5))
+    log.close()
+
+    entries = read_log(path, 'sequence')
+    assert len(entries) == 1
+    assert entries.loc[0, 'shape'] == [190, 800, 800]
+    assert entries.loc[0, 'frames'] == 190
+    assert entries.loc[0, 'size'] == 0.5
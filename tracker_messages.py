@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''
+@time    :   2022/08/23 10:12:39
+@author  :   rosagross
+@contact :   grossmann.rc@gmail.com
+'''
+
+import threading
+import time
+from collections import deque
+
+
+class TrackerMessageQueue(object):
+    """
+    Sends the messages and commands for the eyetracker from a background thread, so a slow link
+    to the EyeLink never holds up the frame loop. sendMessage and sendCommand only append to a
+    deque (appending and popping are atomic, the draw loop never waits for a lock). Everything
+    else (calibration, recording, ...) is passed on to the tracker.
+
+    pylink is not thread-safe, so every call to the tracker holds the queue's lock: the messages
+    sent by the worker, the calls passed on from the main thread and the samples read by the
+    gaze stream (see gaze_stream.PylinkSampleSource).
+
+    Every message is stamped with the time it belongs to, and sent with the delay since then as
+    offset in ms in front of the text. The EyeLink subtracts this offset from the time it got
+    the message, so the message has the original time in the edf file.
+    """
+
+    def __init__(self, tracker, clock, max_backlog=256, poll_interval=0.001, threaded=True):
+        """
+        Parameters
+        ----------
+        tracker : pylink.EyeLink
+            The tracker (or a DummyTracker)
+        clock : callable
+            Returns the current time in s, in the same time base as the stamps (e.g. psychopy.core.getTime)
+        max_backlog : int
+            Number of messages that can wait to be sent, further messages are dropped and counted
+        poll_interval : float
+            Time in s the worker waits before checking again when there is nothing to send
+        threaded : bool
+            If the messages are sent by the worker thread. Without it, they wait until send_pending
+            is called (the dry run does that every flip, on its virtual clock)
+        """
+        self.tracker = tracker
+        self.clock = clock
+        self.max_backlog = max_backlog
+        self.poll_interval = poll_interval
+        self.backlog = deque()
+        self.n_queued = 0
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+        self.max_delay = 0.0
+        self.last_error = None
+        # reentrant, a call that was passed on may use the tracker again
+        self.lock = threading.RLock()
+        self.running = True
+        self.worker = None
+        if threaded:
+            self.worker = threading.Thread(target=self.send_backlog, daemon=True)
+            self.worker.start()
+
+    def __getattr__(self, name):
+        # only called for attributes the queue doesn't have itself
+        if name in ('tracker', 'lock'):
+            raise AttributeError(name)
+        attribute = getattr(self.tracker, name)
+        if not callable(attribute):
+            return attribute
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+    def sendMessage(self, text, timestamp=None):
+        """ Queues a message, timestamp (clock time in s) defaults to now. """
+        self.put('message', text, timestamp)
+
+    def sendCommand(self, text):
+        self.put('command', text, None)
+
+    def put(self, kind, text, timestamp):
+        if timestamp is None:
+            timestamp = self.clock()
+        if not self.running:
+            # after closing, messages are sent right away
+            self.send(kind, text, timestamp)
+        elif len(self.backlog) >= self.max_backlog:
+            self.n_dropped += 1
+        else:
+            self.n_queued += 1
+            self.backlog.append((kind, text, timestamp))
+
+    def send(self, kind, text, timestamp):
+        delay = self.clock() - timestamp
+        self.max_delay = max(self.max_delay, delay)
+        try:
+            with self.lock:
+                if kind == 'message':
+                    self.tracker.sendMessage(f"{int(round(delay*1000))} {text}")
+                else:
+                    self.tracker.sendCommand(text)
+            self.n_sent += 1
+        except Exception as error:
+            self.n_failed += 1
+            self.last_error = error
+
+    def send_backlog(self):
+        """ Runs in the worker thread until the queue is closed and the backlog is empty. """
+        while self.running or self.backlog:
+            if not self.send_pending():
+                time.sleep(self.poll_interval)
+
+    def send_pending(self):
+        """ Sends the messages that are queued, returns False if there were none. """
+        sent = False
+        while True:
+            try:
+                kind, text, timestamp = self.backlog.popleft()
+            except IndexError:
+                return sent
+            self.send(kind, text, timestamp)
+            sent = True
+
+    def flush(self, timeout=1.0):
+        """ Waits until everything queued so far was sent, returns False if that took longer than timeout (s). """
+        if self.worker is None:
+            self.send_pending()
+            return True
+        n_queued = self.n_queued
+        deadline = time.perf_counter() + timeout
+        while self.n_sent + self.n_failed < n_queued:
+            if time.perf_counter() > deadline or not self.worker.is_alive():
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def close(self, timeout=5.0):
+        """ Sends the backlog and stops the worker, later messages are sent directly. """
+        flushed = self.flush(timeout)
+        self.running = False
+        if self.worker is not None:
+            self.worker.join(timeout)
+        return flushed
+
+    def statistics(self):
+        return {'queued': self.n_queued,
+                'sent': self.n_sent,
+                'dropped': self.n_dropped,
+                'failed': self.n_failed,
+                'backlog': len(self.backlog),
+                'max_delay': self.max_delay}
+
+
+class DummyTracker(object):
+    """
+    Local stand-in for pylink's EyeLink, to run the message path without the hardware. Every
+    call takes latency s, like a slow link. Like the EyeLink, a message that starts with a
+    number gets that many ms subtracted from the time it arrived.
+
+    On a virtual clock (sleep None) the calls return right away, the link only counts as busy:
+    a call arrives latency s after the previous call arrived or after it was made.
+    """
+
+    def __init__(self, latency=0.0, clock=time.perf_counter, sleep=time.sleep):
+        self.latency = latency
+        self.clock = clock
+        self.sleep = sleep
+        self.busy_until = 0.0
+        # (time, text) of every message and command
+        self.messages = []
+        self.commands = []
+
+    def transmit(self):
+        """ Returns the time at which a call arrives. """
+        if self.sleep is not None:
+            self.sleep(self.latency)
+            return self.clock()
+        self.busy_until = max(self.clock(), self.busy_until) + self.latency
+        return self.busy_until
+
+    def sendMessage(self, text):
+        arrival = self.transmit()
+        offset, _, message = text.partition(' ')
+        if offset.lstrip('-').isdigit():
+            self.messages.append((arrival - int(offset)/1000, message))
+        else:
+            self.messages.append((arrival, text))
+
+    def sendCommand(self, text):
+        self.commands.append((self.transmit(), text))
@@ -9,11 +9,16 @@
 from psychopy import event
 import numpy as np
 from exptools2.core.trial import Trial
+from responses import response_timing
+from frame_player import frame_schedule
 from psychopy.hardware import keyboard
 import os
 import re
 opj = os.path.join
 
+# upper limit of the refresh rate (Hz), to bound the flips of trials that end by time
+MAX_REFRESHRATE = 1000
+
 
 class RSTrial(Trial):
     """ 
@@ -25,6 +30,25 @@ class RSTrial(Trial):
     Every trial begins with a 10s break.
     """
 
+    # columns of the button press events (see event_buffer.py), in the order they end up in the events file
+    event_columns = {'event_type': object,
+                     'trial_nr': int,
+                     'onset': float,
+                     'reaction_time': float,
+                     'key_duration': float,
+                     'offset_delay': float,
+                     'onset_delay_timing': object,
+                     'offset_delay_timing': object,
+                     'response_button': object,
+                     'phase': int,
+                     'response': object,
+                     'nr_frames': int,
+                     'block_type': object,
+                     'trial_type': object,
+                     'block_ID': int,
+                     'phase_length': int,
+                     'last_frame': int}
+
     def __init__(self, session, trial_nr, block_ID, block_type, trial_type, phase_duration, timing, last_frame_previous, *args, **kwargs):
         
         super().__init__(session, trial_nr, phase_duration,
@@ -43,21 +67,57 @@ class RSTrial(Trial):
         self.block_type = block_type
         self.trial_type = trial_type # this can be either house_face, house or face
         self.last_frame_previous = last_frame_previous
+        # duration of the stimulus in s, used to check the timing of the responses
+        self.duration = self.parameters['phase_length']*self.session.screenticks_per_frame/self.session.monitor_refreshrate
+        # sphere frames that were not shown to keep up with the time (only with 'Frame scheduling: time')
+        self.skipped_frames = 0
+        # flips during which the gaze was away from the fixation dot (only with 'Gaze stream')
+        self.fixation_lost_flips = 0
+
+        # which sphere is shown in which direction, and the frame it shows in every phase
+        self.player, self.direction = self.session.stimulus_for(block_type, trial_type)
+        self.frame_schedule = None
+        if self.player is not None:
+            self.frame_schedule = frame_schedule(len(phase_duration), last_frame_previous, self.session.nr_of_frames)
         
             
+    def log_phase_info(self, phase=None):
+        # the session adds the row of the phase to the global log (see RotatingSphereSession.log_phase)
+        onset = self.session.log_phase(self, phase)
+        self.session.structured_log.debug('phase', trial_nr=self.trial_nr, phase=self.phase if phase is None else phase,
+                                          block_type=self.block_type, trial_type=self.trial_type)
+        # when the trial starts, its onset is added to the session's trial index so that
+        # responses can be assigned to a trial without searching through the global log
+        if (self.phase if phase is None else phase) == 0:
+            self.onset = onset
+            self.session.trial_onsets.setdefault(self.trial_nr, (self.onset, self.duration))
+
     def draw(self):
         ''' This tells what happens in the trial, and this is defined in the session itself. '''
+        # in trials with a sphere every phase shows one sphere frame
+        self.record_flip(self.phase if self.player is not None else -1)
         self.session.draw_stimulus(self.phase)
 
+    def record_flip(self, sphere_frame=-1):
+        """
+        Bookkeeping of every flip: its time and the sphere frame it shows, to check for dropped
+        frames and the rotation speed at the end of the trial, and the fixation. The flip is
+        recorded right after it happened (win.lastFrameT would still be the time of the previous one).
+        """
+        self.session.win.callOnFlip(self.session.flip_recorder.on_flip, sphere_frame)
+        if self.session.fixation_lost():
+            self.fixation_lost_flips += 1
+
 
     def get_events(self):
         """ Logs responses/triggers """
 
-        keys = self.session.kb.getKeys(waitRelease=True)
+        keys = self.session.get_keys()
         for thisKey in keys:
 
             if thisKey==self.session.exit_key:  # it is equivalent to the string 'q'
                 print("End experiment!")
+                self.session.structured_log.warning('abort', trial_nr=self.trial_nr, phase=self.phase)
                 self.session.save_output()
 
                 if self.session.settings['Task settings']['Screenshot']==True:
@@ -80,67 +140,60 @@ class RSTrial(Trial):
                 button_response = np.NaN
 
                 event_type = self.trial_type
-                idx = self.session.global_log.shape[0]     
                 if self.block_type == 'unambiguous':
 
                     # check if the response was still within the same trial
                     if t <  self.session.current_trial_start_time:
                         # now I know that the response offset was in the next trial already
                         # for the reaction time it means we need the onset from previous trial to find the rt
-                        previous_trial = self.session.global_log[self.session.global_log['trial_nr'] == self.trial_nr-1]
-                        previous_trial_onset = previous_trial['onset'].iloc[0]
+                        previous_trial_onset, _ = self.session.trial_onsets[self.trial_nr-1]
                         onset_delay = t - previous_trial_onset
 
-                        # that also means the offset can be tetermined with trial start
-                        offset_delay = self.session.clock.getTime() - self.session.current_trial_start_time
+                        # that also means the offset can be tetermined with trial start (the release is timestamped by the keyboard)
+                        offset_delay = t + thisKey.duration - self.session.current_trial_start_time
                     else:
-                        
-                        current_trial = self.session.global_log[self.session.global_log['trial_nr'] == self.trial_nr].iloc[0]
-                        current_trial_onset = current_trial['onset']
+                        current_trial_onset, trial_duration = self.session.trial_onsets[self.trial_nr]
                         onset_delay = t - current_trial_onset
-
-                        trial_duration = (current_trial['phase_length']*self.session.screenticks_per_frame/self.session.monitor_refreshrate)
                         offset_delay = t - (current_trial_onset + trial_duration)
                     
-                    # check if the onset delay is in time
-                    if (onset_delay >= self.session.response_interval[0]) and (onset_delay <= self.session.response_interval[1]):
-                        onset_delay_timing = 'in_time'
-                    else:
+                    # check if the onset and offset delay are in time
+                    onset_delay_timing = response_timing(onset_delay, self.session.response_interval)
+                    if onset_delay_timing == 'invalid':
                         print("respone took too long or was too quick!")
-                        onset_delay_timing = 'invalid'
-
-                    # check if offset delay is in time 
-                    if (offset_delay >= self.session.response_interval[0]) and (offset_delay <= self.session.response_interval[1]) : 
-                        offset_delay_timing = 'in_time'
-                    else:
-                        offset_delay_timing = 'invalid'
+                    offset_delay_timing = response_timing(offset_delay, self.session.response_interval)
 
                     # based on the offset delay (if the response lasted until the beginning of the
                     # following trial) we can check if the response button was correct
                     # TODO: This has to be implemented in the analysis script, since we never know for sure which buttons were used!
                     #button_response = self.get_button_validity(thisKey.name, offset_delay, event_type)
     
-                self.session.global_log.loc[idx, 'event_type'] = event_type
-                self.session.global_log.loc[idx, 'trial_nr'] = self.trial_nr   
-                self.session.global_log.loc[idx, 'onset'] = t
-                self.session.global_log.loc[idx, 'reaction_time'] = onset_delay
-                self.session.global_log.loc[idx, 'key_duration'] = thisKey.duration
-                self.session.global_log.loc[idx, 'offset_delay'] = offset_delay
-                self.session.global_log.loc[idx, 'onset_delay_timing'] =  onset_delay_timing
-                self.session.global_log.loc[idx, 'offset_delay_timing'] =  offset_delay_timing
-                self.session.global_log.loc[idx, 'response_button'] = self.session.response_button
-                self.session.global_log.loc[idx, 'phase'] = self.phase
-                self.session.global_log.loc[idx, 'response'] = thisKey.name
-                self.session.global_log.loc[idx, 'nr_frames'] = 0
-
-                for param, val in self.parameters.items():
-                    self.session.global_log.loc[idx, param] = val
+                # the press is stored in the session's event buffer and only written to the global log when saving
+                position = self.session.log_length() + len(self.session.event_buffer)
+                self.session.event_buffer.append(position, {'event_type': event_type,
+                                                            'trial_nr': self.trial_nr,
+                                                            'onset': t,
+                                                            'reaction_time': onset_delay,
+                                                            'key_duration': thisKey.duration,
+                                                            'offset_delay': offset_delay,
+                                                            'onset_delay_timing': onset_delay_timing,
+                                                            'offset_delay_timing': offset_delay_timing,
+                                                            'response_button': self.session.response_button,
+                                                            'phase': self.phase,
+                                                            'response': thisKey.name,
+                                                            'nr_frames': 0,
+                                                            **self.parameters})
+
+                self.session.structured_log.info('response', trial_nr=self.trial_nr, phase=self.phase, key=thisKey.name,
+                                                 onset=t, duration=thisKey.duration, reaction_time=onset_delay,
+                                                 timing=onset_delay_timing)
 
                 if self.eyetracker_on:  # send message to eyetracker
                     msg = f'start_type-{event_type}_trial-{self.trial_nr}_phase-{self.phase}_key-{thisKey.name}_time-{t}_duration-{thisKey.duration}'
-                    self.session.tracker.sendMessage(msg)
+                    # stamped with the flip the press was registered at, the message is sent in the background
+                    self.session.tracker.sendMessage(msg, timestamp=self.session.win.lastFrameT)
 
-                if thisKey.name in self.session.break_buttons:
+                # the sphere keeps rotating until the trial is over, the break buttons only end the phases without a sphere
+                if thisKey.name in self.session.break_buttons and self.player is None:
                     print('NEXT PHASE')
                     self.exit_phase = True
 
@@ -182,3 +235,75 @@ class RSTrial(Trial):
 
     
         
+
+
+class ContinuousRSTrial(RSTrial):
+    """
+    Trial that plays the whole rotation of an ambiguous or unambiguous trial as one phase.
+    The phase durations are still given per sphere frame (as for RSTrial), but they are summed
+    into a single phase, and the sphere frame that is drawn follows from the number of flips
+    since the trial started. Only one row per trial ends up in the global log, the shown
+    frames can be logged sparsely in the session's frame log instead (see 'Frame log interval').
+
+    With 'Frame scheduling: time' the sphere frame follows from the time of the flip instead,
+    at 'Screentick conversion' frames per s whatever the refresh rate of the display. After a
+    dropped flip the frames that should have been shown in the meantime are skipped, so the
+    rotation doesn't fall behind, and the trial ends when its time is up.
+    """
+
+    def __init__(self, session, trial_nr, block_ID, block_type, trial_type, phase_duration, timing, last_frame_previous, *args, **kwargs):
+        super().__init__(session, trial_nr, block_ID, block_type, trial_type, phase_duration, timing, last_frame_previous, *args, **kwargs)
+        # phase_length (the number of sphere frames) stays in the parameters, only the phases are merged
+        self.phase_durations = [int(np.sum(phase_duration))]
+        self.n_flips = 0
+        self.sphere_frame = -1
+        self.time_scheduled = self.session.frame_scheduling == 'time'
+        # time of the first flip of the trial, on the flip clock and on the session clock
+        self.first_flip = None
+        self.rotation_onset = None
+        if self.time_scheduled:
+            self.duration = len(phase_duration)/self.session.sphere_frame_rate
+            # the phase is only an upper limit of flips, the trial ends by time (see scheduled_frame)
+            self.phase_durations = [int(np.ceil(self.duration*MAX_REFRESHRATE))]
+
+    def draw(self):
+        if self.n_flips == 0:
+            self.session.win.callOnFlip(self.start_rotation)
+        if self.time_scheduled:
+            sphere_frame = self.scheduled_frame()
+        else:
+            sphere_frame = self.n_flips // self.session.screenticks_per_frame
+        sphere_frame = min(sphere_frame, len(self.frame_schedule)-1)
+        if sphere_frame != self.sphere_frame:
+            if self.sphere_frame >= 0:
+                self.skipped_frames += sphere_frame - self.sphere_frame - 1
+            self.sphere_frame = sphere_frame
+            interval = self.session.frame_log_interval
+            if interval and sphere_frame % interval == 0:
+                # logged when the frame actually appears on the screen
+                self.session.win.callOnFlip(self.session.log_frame, self, sphere_frame)
+        self.record_flip(sphere_frame)
+        self.n_flips += 1
+        self.session.draw_stimulus(sphere_frame)
+
+    def start_rotation(self):
+        """ Called on the first flip, the target times of the sphere frames are counted from here. """
+        self.rotation_onset = self.session.clock.getTime()
+
+    def scheduled_frame(self):
+        """
+        The sphere frame that is due at the upcoming flip, counted from the first flip of the
+        trial (the previous flip is the last one with a known time, the upcoming one is expected
+        one refresh later). Frames are shown from half a refresh before their time, so the
+        jitter of the flips doesn't make them alternate between two frames.
+        """
+        period = self.session.flip_period
+        if self.n_flips == 0:
+            return 0
+        if self.first_flip is None:
+            self.first_flip = self.session.win.lastFrameT
+        flip_time = self.session.win.lastFrameT + period - self.first_flip
+        if flip_time + period >= self.duration - period/2:
+            # the next flip would be after the end of the trial, so this is the last one
+            self.exit_phase = True
+        return int(np.floor((flip_time + period/2)*self.session.sphere_frame_rate))